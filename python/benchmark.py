@@ -0,0 +1,285 @@
+#!encoding=utf-8
+'''
+各章节热点函数的基准测试：对每个场景先预热，再由多个线程或进程并发执行一段时间，
+统计吞吐量和p50/p95/p99延迟，并把结果写入JSON文件，方便比较两次运行的结果
+
+    python benchmark.py --concurrency 8 --duration 10 --output new.json
+    python benchmark.py --compare old.json new.json
+
+运行前需要启动本地的redis-server，基准测试会清空--db指定的数据库
+'''
+import argparse
+import json
+import multiprocessing
+import multiprocessing.pool
+import os
+import random
+import sys
+import time
+import unittest
+import uuid
+
+import redis
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+for chapter in ('ch01', 'ch02', 'ch04'):
+    sys.path.insert(0, os.path.join(HERE, chapter))
+
+import ch01_listing_source as ch01
+import ch02_listing_source as ch02
+import ch04_listing_source as ch04
+
+ARTICLES = 1000     # 场景准备阶段发布的文章数量
+TOKENS = 1000       # 场景准备阶段登陆的用户数量
+ROWS = 1000         # 场景准备阶段调度缓存的数据行数量
+ROW_DELAY = 1e-6    # 数据行的缓存间隔，远小于一次调用的耗时，保证队首的数据行总是已经到期
+
+#--------------- 基准测试场景：setup准备数据，prepare准备每次调用的参数（不计时），op为被测试的调用 ----------------#
+def setup_articles(conn):
+    for i in range(ARTICLES):
+        ch01.post_article(conn, 'user%s' % i, 'title %s' % i, 'http://example.com/%s' % i)
+
+def setup_tokens(conn):
+    for i in range(TOKENS):
+        ch02.update_token(conn, 'token%s' % i, 'user%s' % i, 'item%s' % (i % 100))
+
+def setup_rows(conn):
+    for i in range(ROWS):
+        ch02.schedule_row_cache(conn, 'row%s' % i, ROW_DELAY)
+
+def nothing(conn, *args):
+    '''不需要准备数据或参数的场景使用的空操作'''
+    return ()
+
+def prepare_vote(conn, worker):
+    return ('voter%s:%s' % (worker, uuid.uuid4()), 'article:%s' % random.randint(1, ARTICLES))
+
+def prepare_token(conn, worker):
+    i = random.randrange(TOKENS)
+    return ('token%s' % i, 'user%s' % i, 'item%s' % (i % 100))
+
+def prepare_request(conn, worker):
+    return ('http://test.com/?item=item%s' % random.randrange(100), lambda request: 'content for ' + request)
+
+def prepare_purchase(conn, worker):
+    itemid = 'item%s' % uuid.uuid4()
+    seller, buyer = 'seller%s' % worker, 'buyer%s' % worker
+    conn.hset('users:' + buyer, 'funds', 1 << 40)
+    conn.sadd('inventory:' + seller, itemid)
+    ch04.list_item(conn, itemid, seller, 10)
+    return (buyer, itemid, seller, 10)
+
+SCENARIOS = {
+    'get_articles': (setup_articles, nothing, lambda conn: ch01.get_articles(conn, 1)),
+    'article_vote': (setup_articles, prepare_vote, ch01.article_vote),
+    'check_token': (setup_tokens, lambda conn, worker: prepare_token(conn, worker)[:1], ch02.check_token),
+    'update_token': (setup_tokens, prepare_token, ch02.update_token),
+    'update_token_pipeline': (setup_tokens, prepare_token, ch04.update_token_pipeline),
+    'cache_request': (setup_tokens, prepare_request, ch02.cache_request),
+    'cache_rows': (setup_rows, nothing, ch02.cache_next_row),
+    'purchase_item': (nothing, prepare_purchase, ch04.purchase_item),
+}
+
+#--------------- 运行场景并统计延迟 ----------------#
+def connect(options):
+    return redis.Redis(host=options['host'], port=options['port'], db=options['db'])
+
+def run_worker(args):
+    '''
+    在一个线程或进程中预热warmup秒，然后执行duration秒，返回每次调用的延迟（秒）；
+    使用多进程并统计命令时，同时返回这个进程的命令统计
+    '''
+    name, worker, options = args
+    conn = connect(options)
+    if options['instrument']:
+        ch04.INSTRUMENT = True
+        conn = ch04.instrument(conn)
+    setup, prepare, op = SCENARIOS[name]
+    latencies = []
+    start = time.time()
+    warm = start + options['warmup']
+    end = warm + options['duration']
+    while True:
+        params = prepare(conn, worker)
+        before = time.time()
+        if before >= end:
+            break
+        op(conn, *params)
+        after = time.time()
+        if before >= warm:
+            latencies.append(after - before)
+    if options['instrument'] and options['processes']:
+        return latencies, ch04.get_command_stats()
+    return latencies, None
+
+def percentile(latencies, p):
+    '''已排序的延迟列表的第p百分位数'''
+    if not latencies:
+        return None
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100.0))]
+
+def histogram(latencies):
+    '''按2的幂次微秒划分的延迟直方图：{上界(微秒): 次数}'''
+    buckets = {}
+    for latency in latencies:
+        bound = 1
+        while bound < latency * 1e6:
+            bound *= 2
+        buckets[bound] = buckets.get(bound, 0) + 1
+    return dict((str(bound), count) for bound, count in sorted(buckets.items()))
+
+def merge_stats(total, stats):
+    '''把一个进程的命令统计累加到total中'''
+    for table, rows in stats.items():
+        for row, counters in rows.items():
+            merged = total.setdefault(table, {}).setdefault(row, dict.fromkeys(counters, 0))
+            for counter, value in counters.items():
+                merged[counter] += value
+    return total
+
+def run_scenario(name, options):
+    '''清空数据库并准备数据，然后由concurrency个线程或进程并发执行场景name'''
+    conn = connect(options)
+    conn.flushdb()
+    SCENARIOS[name][0](conn)
+    ch04.reset_command_stats()
+    if options['processes']:
+        pool = multiprocessing.Pool(options['concurrency'])
+    else:
+        pool = multiprocessing.pool.ThreadPool(options['concurrency'])
+    try:
+        results = pool.map(run_worker, [(name, i, options) for i in range(options['concurrency'])])
+    finally:
+        pool.close()
+        pool.join()
+    latencies = sorted(latency for result, stats in results for latency in result)
+    duration = options['duration']
+    summary = {
+        'ops': len(latencies),
+        'rate': len(latencies) / float(duration),
+        'mean': sum(latencies) / len(latencies) if latencies else None,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'max': latencies[-1] if latencies else None,
+        'histogram': histogram(latencies),
+    }
+    if options['instrument']:
+        if options['processes']:
+            commands = {}
+            for result, stats in results:
+                merge_stats(commands, stats)
+        else:
+            commands = ch04.get_command_stats()
+        summary['commands'] = commands
+    return summary
+
+def run_benchmarks(names, options):
+    '''依次运行各个场景，返回可以写入JSON的结果'''
+    conn = connect(options)
+    results = {
+        'time': time.time(),
+        'redis_version': conn.info()['redis_version'],
+        'options': options,
+        'scenarios': {},
+    }
+    for name in names:
+        stats = run_scenario(name, options)
+        results['scenarios'][name] = stats
+        print('%-22s %8d ops %10.1f/s  p50 %.6f  p95 %.6f  p99 %.6f' % (
+            name, stats['ops'], stats['rate'], stats['p50'] or 0, stats['p95'] or 0, stats['p99'] or 0))
+    return results
+
+def compare(old, new, threshold=.1):
+    '''比较两次运行的结果，返回吞吐量下降或p99延迟上升超过threshold的场景'''
+    regressions = []
+    for name, stats in sorted(new['scenarios'].items()):
+        before = old['scenarios'].get(name)
+        if not before or not before['rate'] or not before['p99']:
+            continue
+        if not stats['rate'] or not stats['p99']:
+            # 新的运行中这个场景一次调用都没有完成，这是最严重的退化
+            print('%-22s no completed calls  REGRESSION' % name)
+            regressions.append(name)
+            continue
+        rate = stats['rate'] / before['rate']
+        p99 = stats['p99'] / before['p99']
+        regressed = rate < 1 - threshold or p99 > 1 + threshold
+        print('%-22s rate x%.2f  p99 x%.2f%s' % (name, rate, p99, '  REGRESSION' if regressed else ''))
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the hot paths against a local redis-server.')
+    parser.add_argument('scenarios', nargs='*', help='scenarios to run (default: all)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--db', type=int, default=15, help='database to flush and use')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--processes', action='store_true', help='use processes instead of threads')
+    parser.add_argument('--warmup', type=float, default=1)
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--instrument', action='store_true',
+                        help='count commands and round trips per function and key family')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two JSON result files instead of running')
+    parser.add_argument('--threshold', type=float, default=.1)
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as old, open(args.compare[1]) as new:
+            return 1 if compare(json.load(old), json.load(new), args.threshold) else 0
+
+    names = args.scenarios or sorted(SCENARIOS)
+    for name in names:
+        if name not in SCENARIOS:
+            parser.error('unknown scenario %r, choose from %s' % (name, ', '.join(sorted(SCENARIOS))))
+    options = dict((key, getattr(args, key)) for key in
+                   ('host', 'port', 'db', 'concurrency', 'processes', 'instrument',
+                    'warmup', 'duration'))
+    results = run_benchmarks(names, options)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    return 0
+
+#--------------- Below this line are helpers to test the code ----------------
+
+class TestBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.options = {'host': '127.0.0.1', 'port': 6379, 'db': 15, 'concurrency': 2,
+                        'processes': False, 'instrument': False, 'warmup': .1, 'duration': .5}
+
+    def tearDown(self):
+        connect(self.options).flushdb()
+
+    def test_run_benchmarks(self):
+        results = run_benchmarks(sorted(SCENARIOS), self.options)
+        for name in SCENARIOS:
+            self.assertTrue(results['scenarios'][name]['ops'])
+        json.dumps(results)
+        self.assertFalse(compare(results, results))
+        stalled = json.loads(json.dumps(results))
+        stalled['scenarios']['get_articles'].update(ops=0, rate=0, p99=None)
+        self.assertEqual(compare(results, stalled), ['get_articles'])
+
+    def test_rows_always_due(self):
+        conn = connect(self.options)
+        conn.flushdb()
+        setup_rows(conn)
+        self.assertTrue(all(ch02.cache_next_row(conn) for i in range(2 * ROWS)))
+
+    def test_instrument(self):
+        self.options['instrument'] = True
+        try:
+            stats = run_scenario('update_token_pipeline', self.options)
+        finally:
+            ch04.INSTRUMENT = False
+        functions = stats['commands']['functions']
+        self.assertEqual(functions['update_token_pipeline']['pipelines'],
+                         functions['update_token_pipeline']['round_trips'])
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,14 @@
 #!encoding=utf-8
+import hashlib
+import itertools
+import os
+import sys
 import time
 import unittest
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from leaderboards import WINDOWS, get_window_top, update_windows
+
 ONE_WEEK_IN_SECONDS = 7 * 86400                    
 VOTE_SCORE = 432                                   
 
@@ -14,6 +21,8 @@ def article_vote(conn, user, article):
     if conn.sadd('voted:' + article_id, user):      
         conn.zincrby('score:', article, VOTE_SCORE) 
         conn.hincrby(article, 'votes', 1)           
+        # 记录文章在各个时间窗口内获得的投票数
+        update_windows(conn, 'votes:', {article: 1})
 
 
 def post_article(conn, user, title, link):
@@ -60,13 +69,55 @@ def get_articles(conn, page, order='score:'):
     return articles
 
 
+# 把文章加入或移出群组的Lua函数。KEYS[1]为文章散列（也是群组中的成员），KEYS[2]为文章所属群组的
+# 反向索引groups:<id>，KEYS[3]和KEYS[4]为score:和time:；从KEYS[first_key]开始，每个群组依次是
+# group:<group>、score:<group>和time:<group>三个键，对应的群组名从ARGV[first_arg]开始，前adds个
+# 是要加入的群组，其余是要移除的群组。同时直接修正已经缓存的群组排序score:<group>和time:<group>
+CHANGE_GROUPS_LUA = '''
+local function change_groups(first_key, first_arg, adds)
+    local article = KEYS[1]
+    for i = 0, #ARGV - first_arg do
+        local group = ARGV[first_arg + i]
+        local members = KEYS[first_key + 3 * i]
+        local orders = {{KEYS[3], KEYS[first_key + 3 * i + 1]}, {KEYS[4], KEYS[first_key + 3 * i + 2]}}
+        if i < adds then
+            redis.call('SADD', members, article)
+            redis.call('SADD', KEYS[2], group)
+            for _, order in ipairs(orders) do
+                if redis.call('EXISTS', order[2]) == 1 then
+                    local score = redis.call('ZSCORE', order[1], article)
+                    if score then
+                        redis.call('ZADD', order[2], score, article)
+                    end
+                end
+            end
+        else
+            redis.call('SREM', members, article)
+            redis.call('SREM', KEYS[2], group)
+            redis.call('ZREM', orders[1][2], article)
+            redis.call('ZREM', orders[2][2], article)
+        end
+    end
+end
+'''
+
+ADD_REMOVE_GROUPS_LUA = CHANGE_GROUPS_LUA + '''
+change_groups(5, 2, tonumber(ARGV[1]))
+'''
+
+def group_keys(groups):
+    '''群组groups中每个群组的成员集合以及按评分、发布时间缓存的排序，按CHANGE_GROUPS_LUA的顺序排列'''
+    keys = []
+    for group in groups:
+        keys.extend(['group:' + group, 'score:' + group, 'time:' + group])
+    return keys
+
 def add_remove_groups(conn, article_id, to_add=[], to_remove=[]):
     '''将给定的文章添加到指定分组中(to_add)，或将给定文章移除指定分组(to_remove)'''
-    article = 'article:' + article_id
-    for group in to_add:
-        conn.sadd('group:' + group, article)
-    for group in to_remove:
-        conn.srem('group:' + group, article)
+    groups = list(to_add) + list(to_remove)
+    conn.register_script(ADD_REMOVE_GROUPS_LUA)(
+        keys=['article:' + article_id, 'groups:' + article_id, 'score:', 'time:'] + group_keys(groups),
+        args=[len(to_add)] + groups)
 
 
 
@@ -80,6 +131,217 @@ def get_group_articles(conn, group, page, order='score:'):
     conn.expire(key, 60) 
     return get_articles(conn, page, key)
 
+#--------------- 多个群组的文章 ----------------#
+# 如果缓存的结果不存在，先求出所有群组集合的并集，再与评分或发布时间有序集合求交集得到排序后的文章；
+# 然后取出一页文章，并同时取出每篇文章的详细信息。脚本是原子执行的，
+# 同一组群组的缓存同一时间只会被重建一次，其他请求会直接使用重建好的缓存
+FEED_LUA = '''
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    local union = {'ZUNIONSTORE', KEYS[1], #KEYS - 2}
+    for i = 3, #KEYS do
+        union[#union + 1] = KEYS[i]
+    end
+    redis.call(unpack(union))
+    redis.call('ZINTERSTORE', KEYS[1], 2, KEYS[1], KEYS[2], 'WEIGHTS', 0, 1)
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+end
+local result = {}
+for i, id in ipairs(redis.call('ZREVRANGE', KEYS[1], ARGV[1], ARGV[2])) do
+    result[#result + 1] = id
+    result[#result + 1] = redis.call('HGETALL', id)
+end
+return result
+'''
+
+def get_feed_articles(conn, groups, page, order='score:'):
+    '''在一次往返中获取多个群组中按评分或发布时间排序的文章，同一组群组的排序结果缓存60s'''
+    groups = sorted(set(groups))
+    if not groups:
+        return []
+    key = 'feed:' + order + hashlib.sha1(','.join(groups).encode('utf-8')).hexdigest()
+    start = (page - 1) * ARTICLE_PER_PAGE
+    end = start + ARTICLE_PER_PAGE - 1
+    result = conn.register_script(FEED_LUA)(
+        keys=[key, order] + ['group:' + group for group in groups],
+        args=[start, end, 60])
+    articles = []
+    for i in range(0, len(result), 2):
+        fields = result[i + 1]
+        # 文章可能在缓存的排序结果过期之前被删除
+        if not fields:
+            continue
+        article_data = dict(zip(fields[::2], fields[1::2]))
+        article_data['id'] = result[i]
+        articles.append(article_data)
+    return articles
+
+#--------------- 按小时、天、周统计的排行榜 ----------------#
+def get_top_articles(conn, window, count=10):
+    '''返回最近一小时(hour)、一天(day)或一周(week)内获得投票最多的文章及其投票数'''
+    return get_window_top(conn, 'votes:', window, count)
+
+def import_articles(conn, articles, batch_size=1000):
+    '''
+    批量导入历史文章：articles为可迭代对象，每个元素是包含user、title、link、time，
+    以及可选的votes(默认为1)和groups的字典。每一批文章只用一次INCRBY预留一段连续的id，
+    然后在一个非事务流水线中写入，内存中最多只保留batch_size篇文章。返回导入的文章数量
+    '''
+    articles = iter(articles)
+    count = 0
+    while True:
+        batch = list(itertools.islice(articles, batch_size))
+        if not batch:
+            return count
+        # 预留id：last_id - len(batch) + 1 到 last_id
+        first_id = conn.incr('article:', len(batch)) - len(batch) + 1
+        now = time.time()
+        pipe = conn.pipeline(False)
+        for offset, data in enumerate(batch):
+            article_id = str(first_id + offset)
+            article = 'article:' + article_id
+            posted = data['time']
+            votes = data.get('votes', 1)
+            # 只有还在投票期内的文章需要记录已投票的用户，历史投票用户未知，只记录发布者
+            remaining = int(posted + ONE_WEEK_IN_SECONDS - now)
+            if remaining > 0:
+                voted = 'voted:' + article_id
+                pipe.sadd(voted, data['user'])
+                pipe.expire(voted, remaining)
+            pipe.hmset(article, {
+                'title': data['title'],
+                'link': data['link'],
+                'poster': data['user'],
+                'time': posted,
+                'votes': votes,
+            })
+            pipe.zadd('score:', article, posted + votes * VOTE_SCORE)
+            pipe.zadd('time:', article, posted)
+            for group in data.get('groups', ()):
+                pipe.sadd('group:' + group, article)
+                pipe.sadd('groups:' + article_id, group)
+        pipe.execute()
+        count += len(batch)
+
+def benchmark_import_articles(conn, count):
+    '''比较逐篇调用post_article和批量导入import_articles每秒能写入的文章数量'''
+    now = time.time()
+    articles = [{
+        'user': 'user%s' % i,
+        'title': 'title %s' % i,
+        'link': 'http://www.example.com/%s' % i,
+        'time': now - i,
+    } for i in range(count)]
+
+    start = time.time()
+    for data in articles:
+        post_article(conn, data['user'], data['title'], data['link'])
+    delta = time.time() - start
+    print('post_article', count, delta, count / delta)
+
+    start = time.time()
+    import_articles(conn, iter(articles))
+    delta = time.time() - start
+    print('import_articles', count, delta, count / delta)
+
+#--------------- 删除和修改文章 ----------------#
+# 根据反向索引groups:<id>，只从文章所在的群组以及这些群组缓存的排序中移除文章，
+# 再从评分、发布时间和各个时间窗口的排行榜中移除文章，最后删除文章的散列、已投票用户和反向索引。
+# 群组的键由客户端根据先读取的反向索引传入，反向索引在此期间被修改时返回-1，由客户端重试。
+# KEYS依次为文章散列、反向索引、已投票用户、score:、time:、ARGV[1]个时间窗口，然后是每个群组的三个键
+DELETE_ARTICLE_LUA = '''
+local article = KEYS[1]
+if redis.call('EXISTS', article) == 0 then
+    return 0
+end
+local first = 6 + tonumber(ARGV[1])
+local groups = #ARGV - 1
+if redis.call('SCARD', KEYS[2]) ~= groups then
+    return -1
+end
+for i = 0, groups - 1 do
+    if redis.call('SISMEMBER', KEYS[2], ARGV[2 + i]) == 0 then
+        return -1
+    end
+end
+for i = 0, groups - 1 do
+    redis.call('SREM', KEYS[first + 3 * i], article)
+    redis.call('ZREM', KEYS[first + 3 * i + 1], article)
+    redis.call('ZREM', KEYS[first + 3 * i + 2], article)
+end
+redis.call('ZREM', KEYS[4], article)
+redis.call('ZREM', KEYS[5], article)
+for i = 6, first - 1 do
+    redis.call('ZREM', KEYS[i], article)
+end
+redis.call('DEL', article, KEYS[3], KEYS[2])
+return 1
+'''
+
+UPDATE_ARTICLE_LUA = CHANGE_GROUPS_LUA + '''
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+local fields = tonumber(ARGV[1])
+for i = 3, 2 + 2 * fields, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+change_groups(5, 3 + 2 * fields, tonumber(ARGV[2]))
+return 1
+'''
+
+def delete_article(conn, article_id):
+    '''原子地删除文章及其所有索引，文章不存在时返回False'''
+    article = 'article:' + article_id
+    index = 'groups:' + article_id
+    windows = ['votes:%s:' % window for window, size in WINDOWS]
+    delete = conn.register_script(DELETE_ARTICLE_LUA)
+    while True:
+        groups = [group.decode('utf-8') if isinstance(group, bytes) else group
+                  for group in conn.smembers(index)]
+        result = delete(
+            keys=[article, index, 'voted:' + article_id, 'score:', 'time:'] + windows + group_keys(groups),
+            args=[len(windows)] + groups)
+        # 读取反向索引之后文章的群组发生了变化，重新读取后重试
+        if result >= 0:
+            return bool(result)
+
+INDEXED_FIELDS = ('time', 'votes') # 与score:、time:以及群组的排序同步的字段，不能直接修改
+
+def update_article(conn, article_id, fields={}, to_add=[], to_remove=[]):
+    '''
+    原子地修改文章的信息(fields，例如title和link)，并把文章加入群组to_add、移出群组to_remove，
+    文章不存在时返回False
+    '''
+    for field in INDEXED_FIELDS:
+        if field in fields:
+            raise ValueError("the %r field is indexed and can't be edited" % field)
+    groups = list(to_add) + list(to_remove)
+    args = [len(fields), len(to_add)]
+    for field, value in fields.items():
+        args.extend([field, value])
+    return bool(conn.register_script(UPDATE_ARTICLE_LUA)(
+        keys=['article:' + article_id, 'groups:' + article_id, 'score:', 'time:'] + group_keys(groups),
+        args=args + groups))
+
+def backfill_group_index(conn, batch=500):
+    '''
+    一次性任务：为在反向索引groups:<id>出现之前就被加入群组的文章补建索引，
+    否则删除这些文章时不会把它们从群组中移除。用SCAN和SSCAN分批遍历所有群组，可以在线重复执行，
+    返回补建的索引条目数量
+    '''
+    added = 0
+    for key in conn.scan_iter(match='group:*', count=batch):
+        group = key.decode('utf-8') if isinstance(key, bytes) else key
+        group = group.partition(':')[-1]
+        pipe = conn.pipeline(False)
+        for article in conn.sscan_iter(key, count=batch):
+            article = article.decode('utf-8') if isinstance(article, bytes) else article
+            pipe.sadd('groups:' + article.partition(':')[-1], group)
+            if len(pipe) >= batch:
+                added += sum(pipe.execute())
+        added += sum(pipe.execute())
+    return added
+
 #-------------- Below this line are helpers to test the code ----------------#
 
 class TestCh01(unittest.TestCase):
@@ -132,9 +394,100 @@ class TestCh01(unittest.TestCase):
         print
         self.assertTrue(len(articles) >= 1)
 
+        add_remove_groups(conn, article_id, ['other-group'])
+        print("Articles from both groups, in one round trip:")
+        articles = get_feed_articles(conn, ['new-group', 'other-group'], 1)
+        pprint.pprint(articles)
+        print
+        self.assertTrue(len(articles) >= 1)
+        self.assertEqual(len(set(a['id'] for a in articles)), len(articles))
+        self.assertEqual(get_feed_articles(conn, [], 1), [])
+
+        print("The articles with the most votes today are:")
+        top = get_top_articles(conn, 'day')
+        print(top)
+        self.assertTrue(top)
+        self.assertEqual(get_top_articles(conn, 'hour'), get_top_articles(conn, 'week'))
+
         to_del = (
             conn.keys('time:*') + conn.keys('voted:*') + conn.keys('score:*') + 
-            conn.keys('article:*') + conn.keys('group:*')
+            conn.keys('article:*') + conn.keys('group:*') + conn.keys('votes:*') +
+            conn.keys('feed:*') + conn.keys('groups:*')
+        )
+        if to_del:
+            conn.delete(*to_del)
+
+    def test_import_articles(self):
+        conn = self.conn
+        now = time.time()
+        articles = [{
+            'user': 'username',
+            'title': 'Old title %s' % i,
+            'link': 'http://www.google.com/%s' % i,
+            'time': now - i * 86400,
+            'votes': i,
+            'groups': ['old-group'],
+        } for i in range(1, 11)]
+
+        print("We imported some historical articles in batches of 4")
+        self.assertEqual(import_articles(conn, iter(articles), 4), 10)
+        ids = conn.zrevrange('time:', 0, 9)
+        self.assertEqual(len(ids), 10)
+        r = conn.hgetall(ids[-1])
+        print("The oldest one looks like:", r)
+        self.assertTrue(r)
+        self.assertEqual(conn.scard('group:old-group'), 10)
+        # 只有发布不到一周的6篇文章还可以投票
+        self.assertEqual(len(conn.keys('voted:*')), 6)
+
+        print("Importing is usually much faster than posting one at a time:")
+        benchmark_import_articles(conn, 1000)
+
+        to_del = (
+            conn.keys('time:*') + conn.keys('voted:*') + conn.keys('score:*') +
+            conn.keys('article:*') + conn.keys('group:*') + conn.keys('groups:*')
+        )
+        if to_del:
+            conn.delete(*to_del)
+
+    def test_delete_article(self):
+        conn = self.conn
+        first = str(post_article(conn, 'username', 'A title', 'http://www.google.com'))
+        second = str(post_article(conn, 'username', 'Another title', 'http://www.bing.com'))
+        add_remove_groups(conn, first, ['group-a', 'group-b'])
+        add_remove_groups(conn, second, ['group-a'])
+        self.assertEqual(len(get_group_articles(conn, 'group-a', 1)), 2)
+        self.assertEqual(len(get_group_articles(conn, 'group-b', 1)), 1)
+        self.assertEqual(len(conn.smembers('groups:' + first)), 2)
+
+        print("We edited the second article and moved it from group-a to group-b")
+        self.assertTrue(update_article(conn, second, {'title': 'A new title'}, ['group-b'], ['group-a']))
+        self.assertEqual(conn.hget('article:' + second, 'title'), 'A new title')
+        print("The cached group rankings were fixed up in place:")
+        print(conn.zrange('score:group-a', 0, -1), conn.zrange('score:group-b', 0, -1))
+        self.assertEqual(conn.zcard('score:group-a'), 1)
+        self.assertEqual(conn.zcard('score:group-b'), 2)
+        self.assertFalse(conn.sismember('group:group-a', 'article:' + second))
+        self.assertRaises(ValueError, update_article, conn, second, {'votes': 1000})
+
+        print("Articles grouped before the reverse index existed are indexed by the backfill")
+        conn.delete('groups:' + first)
+        self.assertTrue(backfill_group_index(conn) >= 2)
+        self.assertEqual(len(conn.smembers('groups:' + first)), 2)
+
+        print("Then we deleted the first article")
+        self.assertTrue(delete_article(conn, first))
+        self.assertFalse(delete_article(conn, first))
+        self.assertFalse(update_article(conn, first, {'title': 'Gone'}))
+        self.assertFalse(conn.exists('article:' + first))
+        self.assertFalse(conn.exists('groups:' + first))
+        self.assertFalse(conn.zscore('score:', 'article:' + first))
+        self.assertFalse(conn.scard('group:group-a'))
+        self.assertEqual(conn.zcard('score:group-b'), 1)
+
+        to_del = (
+            conn.keys('time:*') + conn.keys('voted:*') + conn.keys('score:*') +
+            conn.keys('article:*') + conn.keys('group:*') + conn.keys('groups:*')
         )
         if to_del:
             conn.delete(*to_del)
@@ -1,10 +1,22 @@
 #!encoding=utf-8
+import hashlib
 import json
+import math
+import os
+import random
+import struct
+import sys
 import threading
 import time
 import unittest
-import urllib
 import uuid
+try:
+    from urllib.parse import parse_qs, urlparse
+except ImportError:
+    from urlparse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from leaderboards import get_window_top, update_windows
 
 #--------------- 登陆和cookie缓存 ----------------#
 def check_token(conn, token):
@@ -19,15 +31,26 @@ def update_token(conn, token, user, item=None):
     当被记录的商品数量超过25个时，通过时间排序移除那些旧的浏览商品
     '''
     timestamp = time.time()
-    conn.hset('login:', token, user)
-    conn.zadd('recent:', token, timestamp)
+    # 这些命令互不依赖，在一个非事务流水线中一次发送
+    pipe = conn.pipeline(False)
+    pipe.hset('login:', token, user)
+    pipe.zadd('recent:', token, timestamp)
+    # 会话仍然活跃，刷新购物车的过期时间
+    pipe.expire('cart:' + token, SESSION_TTL)
     if item:
-        conn.zadd('viewed:' + token, item, timestamp)
+        pipe.zadd('viewed:' + token, item, timestamp)
         # 通过时间戳进行排序，那么时间戳分值越大，则越靠后，
         # 这里删除从0到倒数第26名的浏览商品，剩下的及时最新浏览的25个商品
-        conn.zremrangebyrank('viewed:' + token, 0, -26)
-        # 记录所有商品的浏览次数
-        conn.zincrby('viewed:', item, -1)
+        pipe.zremrangebyrank('viewed:' + token, 0, -26)
+        if VIEW_SKETCH:
+            # 使用近似统计时，只在本地累加浏览次数，由flush_view_counts定期批量写入近似统计和各个时间窗口
+            record_view(item)
+        else:
+            # 记录所有商品的浏览次数，按当前时刻的衰减权重累加（权重随时间指数增长，等价于旧记录不断衰减）
+            view_item(conn, item, timestamp, client=pipe)
+            # 记录商品在各个时间窗口内的浏览次数
+            update_windows(conn, 'views:', {item: 1}, client=pipe, now=timestamp)
+    pipe.execute()
 
 QUIT = False
 LIMIT = 10000000 # 只保存1千万个登陆会话（即1千万个当前登陆用户与其令牌映射值）
@@ -59,14 +82,57 @@ def clean_sessions(conn):
 
 
 #--------------- 实现购物车 ----------------#
+SESSION_TTL = 7 * 86400 # 购物车的过期时间，每次会话更新时都会刷新，保证购物车不会比会话活得更久
+
 def add_to_cart(conn, session, item, count):
     '''
     如果购物车内商品的输入小于0时，从购物车移除指定商品；否则更新商品的数量
     '''
-    if count <= 0:
-        conn.hdel('cart:' + session, item)
-    else:
-        conn.hset('cart' + session, item, count)
+    update_cart(conn, session, {item: count})
+
+def update_cart(conn, session, items):
+    '''
+    一次性更新购物车内的多个商品：items为商品到数量的映射，数量小于等于0的商品从购物车移除，
+    其余商品更新为给定的数量。所有修改在一个事务流水线中执行，只需要一次往返
+    '''
+    cart = 'cart:' + session
+    to_set = dict((item, count) for item, count in items.items() if count > 0)
+    to_remove = [item for item, count in items.items() if count <= 0]
+    pipe = conn.pipeline()
+    if to_set:
+        pipe.hmset(cart, to_set)
+    if to_remove:
+        pipe.hdel(cart, *to_remove)
+    pipe.expire(cart, SESSION_TTL)
+    pipe.execute()
+
+# 读取购物车内的所有商品，并同时取出每个商品被缓存的数据行inv:<item>，
+# 返回 商品、数量、数据行 的扁平列表，数据行未被缓存时为nil
+CART_SNAPSHOT_LUA = '''
+local cart = redis.call('HGETALL', KEYS[1])
+local result = {}
+for i = 1, #cart, 2 do
+    result[#result + 1] = cart[i]
+    result[#result + 1] = cart[i + 1]
+    result[#result + 1] = redis.call('GET', 'inv:' .. cart[i])
+end
+return result
+'''
+
+def get_cart(conn, session):
+    '''
+    在一次往返中读取购物车快照：返回商品到{'count': 数量, 'row': 数据行}的映射，
+    数据行来自cache_rows缓存的inv:，没有被缓存的商品对应None
+    '''
+    snapshot = conn.register_script(CART_SNAPSHOT_LUA)(keys=['cart:' + session])
+    cart = {}
+    for i in range(0, len(snapshot), 3):
+        row = snapshot[i + 2]
+        cart[snapshot[i]] = {
+            'count': int(snapshot[i + 1]),
+            'row': json.loads(row) if row else None,
+        }
+    return cart
 
 def clean_full_sessions(conn):
     '''清除会话，并清除与会话对应的用户的购物车'''
@@ -82,19 +148,36 @@ def clean_full_sessions(conn):
             session_keys.append('viewed:' + str(sess))
             session_keys.append('cart:' + str(sess))
 
-        conn.delete(*sessions)
-        conn.hdel('login:', *session_keys)
-        conn.hdel('recent:', *session_keys)
+        conn.delete(*session_keys)
+        conn.hdel('login:', *sessions)
+        conn.zrem('recent:', *sessions)
 
 #--------------- 实现网页缓存：对能够缓存的请求，将请求缓存到redis中，然后从redis中返回被缓存的页面 ----------------#
+CACHE_RANK_LIMIT = 10000 # 浏览次数排名在这之前的商品页面才会被缓存
+
+# 在一次往返中检查商品的浏览次数排名，排名足够靠前时同时取出被缓存的页面
+CACHE_LOOKUP_LUA = '''
+local rank = redis.call('ZRANK', KEYS[1], ARGV[1])
+if not rank or rank >= tonumber(ARGV[2]) then
+    return {0}
+end
+return {1, redis.call('GET', KEYS[2])}
+'''
+
 def cache_request(conn, request, callback):
     '''对请求进行缓存'''
     # 如果是对于不能缓存的请求，直接调用回调函数
-    if not can_cache(conn, request):
+    item_id = extract_item_id(request)
+    if not item_id or is_dynamic(request):
         return callback(request)
-    # 否则尝试从redis中查找被缓存的页面
+    # 否则检查商品的浏览次数排名，并同时尝试从redis中查找被缓存的页面
     page_key = 'cache:' + hash_request(request)
-    content = conn.get(page_key)
+    lookup = conn.register_script(CACHE_LOOKUP_LUA)(
+        keys=['viewed-topk:' if VIEW_SKETCH else 'viewed:', page_key],
+        args=[item_id, CACHE_RANK_LIMIT])
+    if not lookup[0]:
+        return callback(request)
+    content = lookup[1]
     # 如果页面没有被缓存，将调用回调函数生成的页面缓存到redis中，设置过期时间为5分钟
     if not content:
         content = callback(request)
@@ -113,40 +196,151 @@ def schedule_row_cache(conn, row_id, delay):
 def cache_rows(conn):
     '''守护进程函数'''
     while not QUIT:
-        # 获取下一个需要被缓存的数据行以及该行的调度时间戳，命令会返回一个包含0个或者1个元组的列表
-        next = conn.zrange('schedule:', 0, 0, withscores=True)
-        now = time.time()
         # 如果暂时没有数据行被缓存，或者被缓存的数据行的调度时间戳未到，则等待50ms后继续检查
-        if not next or next[0][1] > now:
+        if not cache_next_row(conn):
             time.sleep(.05)
-            continue
-        row_id = next[0][0]
-        
-        # 提前获取下一次调度的延迟时间,如果数据行的延迟时间小于0，从延迟有序集合和调度有序集合移除这个数据行
-        delay = conn.zscore('delay:', row_id)
-        if delay <= 0:
-            conn.zrem('delay:', row_id)
-            conn.zrem('schedule:', row_id)
-            conn.delete('inv:' + row_id)
-            continue
-        # 如果延迟值大于0，缓存函数从数据库中取出这些行，
-        # 将它们编码为JSON格式并存储到redis中，然后更新这些行的调度时间
-        row = Inventory.get(row_id)
-        conn.zadd('schedule:', row_id, now + delay)
-        conn.set('inv:' + str(row_id), json.dumps(row.to_dict()))
+
+def cache_next_row(conn):
+    '''缓存下一个到期的数据行，没有到期的数据行时返回False'''
+    # 获取下一个需要被缓存的数据行以及该行的调度时间戳，命令会返回一个包含0个或者1个元组的列表
+    next = conn.zrange('schedule:', 0, 0, withscores=True)
+    now = time.time()
+    if not next or next[0][1] > now:
+        return False
+    row_id = next[0][0]
+
+    # 提前获取下一次调度的延迟时间,如果数据行的延迟时间小于0，从延迟有序集合和调度有序集合移除这个数据行
+    delay = conn.zscore('delay:', row_id)
+    if delay <= 0:
+        conn.zrem('delay:', row_id)
+        conn.zrem('schedule:', row_id)
+        conn.delete('inv:' + row_id)
+        return True
+    # 如果延迟值大于0，缓存函数从数据库中取出这些行，
+    # 将它们编码为JSON格式并存储到redis中，然后更新这些行的调度时间
+    row = Inventory.get(row_id)
+    conn.zadd('schedule:', row_id, now + delay)
+    conn.set('inv:' + str(row_id), json.dumps(row.to_dict()))
+    return True
 
 
 #--------------- 对网页进行分析：实现对浏览次数多的商品排名 ----------------#
+VIEWED_LIMIT = 20000                # viewed:有序集合最多保留的商品数量
+VIEWED_TAU = 5 / math.log(2)        # 衰减时间常数：浏览次数每5秒衰减一半，与原来的ZINTERSTORE减半保持一致
+VIEWED_RENORMALIZE = 600            # 权重增长超过这么多秒后，把已有分值归一化到新的衰减起点
+VIEWED_MAX_EXPONENT = 500           # 权重指数的上限，守护进程停止时权重不再增长，避免浮点数溢出
+VIEWED_CHUNK = 1000                 # 每次裁剪或归一化最多处理的商品数量，保证守护进程每轮耗时有界
+
+# 在服务器端按衰减起点viewed-epoch:计算这次浏览的权重exp((t - epoch) / tau)并累加，
+# 所以衰减起点的前移与权重的计算不会交错。归一化进行中（viewed-rescale:保存新的衰减起点）时，
+# 同时把商品按新起点缩放后的分值写入viewed-next:，保证viewed-next:始终等于viewed:的缩放
+VIEW_ITEM_LUA = '''
+local now = tonumber(ARGV[2])
+local tau = tonumber(ARGV[3])
+local epoch = tonumber(redis.call('GET', KEYS[2]))
+if not epoch then
+    epoch = now
+    redis.call('SET', KEYS[2], ARGV[2])
+end
+local exponent = math.min((now - epoch) / tau, tonumber(ARGV[4]))
+local score = tonumber(redis.call('ZINCRBY', KEYS[1], -math.exp(exponent), ARGV[1]))
+local target = redis.call('GET', KEYS[3])
+if target then
+    redis.call('ZADD', KEYS[4], score * math.exp((epoch - tonumber(target)) / tau), ARGV[1])
+end
+return tostring(score)
+'''
+
+# 把一批商品按viewed:中的当前分值缩放到新的衰减起点后写入viewed-next:，重复处理同一个商品的结果相同
+COPY_VIEWED_LUA = '''
+local target = redis.call('GET', KEYS[4])
+if not target then
+    return 0
+end
+local factor = math.exp((tonumber(redis.call('GET', KEYS[3])) - tonumber(target)) / tonumber(ARGV[1]))
+for i = 2, #ARGV do
+    local score = redis.call('ZSCORE', KEYS[1], ARGV[i])
+    if score then
+        redis.call('ZADD', KEYS[2], tonumber(score) * factor, ARGV[i])
+    end
+end
+return #ARGV - 1
+'''
+
+# 所有商品都已复制到viewed-next:，用它替换viewed:并同时前移衰减起点
+FINISH_RESCALE_LUA = '''
+local target = redis.call('GET', KEYS[4])
+if not target then
+    return 0
+end
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    redis.call('RENAME', KEYS[2], KEYS[1])
+else
+    redis.call('DEL', KEYS[1])
+end
+redis.call('SET', KEYS[3], target)
+redis.call('DEL', KEYS[4])
+return 1
+'''
+
+VIEWED_KEYS = ['viewed:', 'viewed-next:', 'viewed-epoch:', 'viewed-rescale:']
+
+def view_item(conn, item, timestamp=None, client=None):
+    '''
+    按timestamp时刻的衰减权重累加商品的浏览次数，返回商品新的分值；
+    给定流水线client时只把脚本加入流水线
+    '''
+    return conn.register_script(VIEW_ITEM_LUA)(
+        keys=['viewed:', 'viewed-epoch:', 'viewed-rescale:', 'viewed-next:'],
+        args=[item, repr(timestamp or time.time()), VIEWED_TAU, VIEWED_MAX_EXPONENT],
+        client=client)
+
+def start_rescale(conn):
+    '''衰减起点落后超过VIEWED_RENORMALIZE秒时开始一次归一化，返回是否有归一化正在进行'''
+    epoch, target = conn.mget('viewed-epoch:', 'viewed-rescale:')
+    if target is not None:
+        # 上一次归一化没有完成（例如守护进程被重启），从头继续复制即可
+        return True
+    if epoch is None or time.time() - float(epoch) <= VIEWED_RENORMALIZE:
+        return False
+    epoch = float(epoch)
+    # 新的衰减起点最多前移VIEWED_MAX_EXPONENT个时间常数，保证缩放系数不会下溢为0
+    target = epoch + min(time.time() - epoch, VIEWED_MAX_EXPONENT * VIEWED_TAU)
+    conn.delete('viewed-next:')
+    return bool(conn.setnx('viewed-rescale:', repr(target)))
+
 def rescale_viewed(conn):
     '''
     守护进程函数：对商品浏览次数进行更新
+    浏览次数的衰减由update_token中不断增长的权重完成，这里不再整体重写viewed:，
+    只需要分批裁剪多余的商品，并在权重过大之前把分值归一化到新的衰减起点：
+    用ZSCAN分批把缩放后的分值复制到viewed-next:，期间的浏览由VIEW_ITEM_LUA同时写入两个有序集合，
+    复制完成后原子地替换viewed:并前移衰减起点。读取排名的一方始终只看到同一个衰减起点下的分值，
+    复制的进度也只取决于ZSCAN的游标，与商品的排名变化无关
     '''
+    if VIEW_SKETCH:
+        return rescale_view_sketch(conn)
+    copy = conn.register_script(COPY_VIEWED_LUA)
+    finish = conn.register_script(FINISH_RESCALE_LUA)
+    cursor = None                   # 正在进行的归一化的ZSCAN游标
     while not QUIT:
-        # 删除排名在20000名后的所有商品
-        conn.zremrangebyrank('viewed:', 0, -20001)
-        # 将浏览次数降低为原来的一般
-        conn.zinterstore('viewed:', {'viewed:' : .5})
-        time.sleep(5)
+        if cursor is None and start_rescale(conn):
+            cursor = 0
+        if cursor is not None:
+            cursor, items = conn.zscan('viewed:', cursor, count=VIEWED_CHUNK)
+            if items:
+                copy(keys=VIEWED_KEYS, args=[VIEWED_TAU] + [item for item, score in items])
+            if not int(cursor):
+                finish(keys=VIEWED_KEYS)
+                cursor = None
+            time.sleep(.01)
+            continue
+
+        # 删除排名在VIEWED_LIMIT之后（浏览最少）的商品，每轮最多删除VIEWED_CHUNK个；
+        # 归一化期间暂停裁剪，保证viewed-next:包含viewed:中的所有商品
+        removed = conn.zremrangebyrank(
+            'viewed:', VIEWED_LIMIT, VIEWED_LIMIT + VIEWED_CHUNK - 1)
+        time.sleep(.01 if removed else 1)
 
 def can_cache(conn, request):
     # 从页面取出商品id
@@ -156,19 +350,147 @@ def can_cache(conn, request):
         return False
     # 取得商品的浏览次数排名
     # 根据商品的浏览次数排名判断是否需要缓存这个页面 
-    rank = conn.zrank('viewed:', item_id)
-    return rank is not None and rank < 10000
+    rank = conn.zrank('viewed-topk:' if VIEW_SKETCH else 'viewed:', item_id)
+    return rank is not None and rank < CACHE_RANK_LIMIT
+
+#--------------- 近似统计商品浏览次数：Count-Min Sketch + Top-K ----------------#
+VIEW_SKETCH = False          # 为True时，update_token、can_cache和rescale_viewed改用近似统计代替viewed:
+VIEW_SKETCH_WIDTH = 4096     # 每行计数器的数量，高估的误差不超过 e / 4096 * 总浏览次数
+VIEW_SKETCH_DEPTH = 4        # 计数器的行数，一个md5摘要正好切分成4个哈希值，误差超出上界的概率为 e ** -4
+VIEW_TOPK = 10000            # viewed-topk:中保留浏览次数最多的商品数量
+VIEW_FLUSH_INTERVAL = 1      # 本地累加的浏览次数写入Redis的间隔
+_PENDING_VIEWS = {}
+_PENDING_LOCK = threading.Lock()
+
+# 对每个商品，把本地累加的次数加到Count-Min Sketch的每一行中，取各行的最小值作为估计的
+# 浏览次数，再用估计值更新Top-K有序集合。分值取负数，与viewed:一样排名越靠前浏览越多
+FLUSH_VIEWS_LUA = '''
+local depth = tonumber(ARGV[2])
+local i = 3
+while i <= #ARGV do
+    local estimate = nil
+    for j = 1, depth do
+        local value = redis.call('HINCRBY', KEYS[1], ARGV[i + 1 + j], ARGV[i + 1])
+        if not estimate or value < estimate then
+            estimate = value
+        end
+    end
+    redis.call('ZADD', KEYS[2], -estimate, ARGV[i])
+    i = i + 2 + depth
+end
+redis.call('ZREMRANGEBYRANK', KEYS[2], ARGV[1], -1)
+'''
+
+# 把所有计数器和Top-K的分值都减半，计数器的数量固定，所以耗时不会随商品数量增长
+DECAY_VIEWS_LUA = '''
+local counters = redis.call('HGETALL', KEYS[1])
+for i = 1, #counters, 2 do
+    local value = math.floor(tonumber(counters[i + 1]) / 2)
+    if value > 0 then
+        redis.call('HSET', KEYS[1], counters[i], value)
+    else
+        redis.call('HDEL', KEYS[1], counters[i])
+    end
+end
+redis.call('ZUNIONSTORE', KEYS[2], 1, KEYS[2], 'WEIGHTS', .5)
+'''
+
+def sketch_fields(item):
+    '''计算商品在Count-Min Sketch每一行中对应的计数器'''
+    digest = hashlib.md5(str(item).encode('utf-8')).digest()
+    hashes = struct.unpack('>%dI' % VIEW_SKETCH_DEPTH, digest[:4 * VIEW_SKETCH_DEPTH])
+    return ['%d:%d' % (row, h % VIEW_SKETCH_WIDTH) for row, h in enumerate(hashes)]
+
+def record_view(item, count=1):
+    '''在本地累加商品的浏览次数'''
+    with _PENDING_LOCK:
+        _PENDING_VIEWS[item] = _PENDING_VIEWS.get(item, 0) + count
+
+def flush_views(conn):
+    '''把本地累加的浏览次数一次性写入Count-Min Sketch、Top-K和各个时间窗口，返回写入的商品数量'''
+    global _PENDING_VIEWS
+    with _PENDING_LOCK:
+        pending, _PENDING_VIEWS = _PENDING_VIEWS, {}
+    if not pending:
+        return 0
+    args = [VIEW_TOPK, VIEW_SKETCH_DEPTH]
+    for item, count in pending.items():
+        args.append(item)
+        args.append(count)
+        args.extend(sketch_fields(item))
+    pipe = conn.pipeline(False)
+    conn.register_script(FLUSH_VIEWS_LUA)(
+        keys=['viewed-sketch:', 'viewed-topk:'], args=args, client=pipe)
+    update_windows(conn, 'views:', pending, client=pipe)
+    pipe.execute()
+    return len(pending)
+
+def flush_view_counts(conn):
+    '''守护进程函数：定期把本地累加的浏览次数写入Redis'''
+    while not QUIT:
+        flush_views(conn)
+        time.sleep(VIEW_FLUSH_INTERVAL)
+    flush_views(conn)
+
+def estimate_views(conn, item):
+    '''从Count-Min Sketch中估计商品的浏览次数，估计值只会偏大'''
+    counts = conn.hmget('viewed-sketch:', sketch_fields(item))
+    return min(int(count or 0) for count in counts)
+
+def rescale_view_sketch(conn):
+    '''守护进程函数：与rescale_viewed相同，每5秒把近似统计的浏览次数减半'''
+    decay = conn.register_script(DECAY_VIEWS_LUA)
+    while not QUIT:
+        decay(keys=['viewed-sketch:', 'viewed-topk:'])
+        time.sleep(5)
+
+def benchmark_view_tracking(conn, views=100000, items=10000, top=100):
+    '''比较精确的ZINCRBY与近似统计的写入吞吐量，以及近似统计得到的热门商品的准确度'''
+    stream = ['item%d' % min(int(random.paretovariate(1.2)), items) for i in range(views)]
+    exact = {}
+    for item in stream:
+        exact[item] = exact.get(item, 0) + 1
+
+    conn.delete('viewed:', 'viewed-sketch:', 'viewed-topk:')
+    start = time.time()
+    for item in stream:
+        conn.zincrby('viewed:', item, -1)
+    zincrby_delta = time.time() - start
+
+    start = time.time()
+    for i, item in enumerate(stream):
+        record_view(item)
+        if i % 1000 == 999:
+            flush_views(conn)
+    flush_views(conn)
+    sketch_delta = time.time() - start
+
+    hottest = sorted(exact, key=exact.get, reverse=True)[:top]
+    found = conn.zrange('viewed-topk:', 0, top - 1)
+    overlap = len(set(conn.zrange('viewed:', 0, top - 1)) & set(found)) / float(top)
+    error = sum(
+        (estimate_views(conn, item) - exact[item]) / float(exact[item])
+        for item in hottest) / len(hottest)
+    print('zincrby', views, zincrby_delta, views / zincrby_delta)
+    print('sketch', views, sketch_delta, views / sketch_delta)
+    print('top-%d overlap' % top, overlap, 'mean relative error', error)
+    return overlap, error
+
+#--------------- 按小时、天、周统计的排行榜 ----------------#
+def get_top_items(conn, window, count=10):
+    '''返回最近一小时(hour)、一天(day)或一周(week)内浏览次数最多的商品及其浏览次数'''
+    return get_window_top(conn, 'views:', window, count)
 
 #--------------- Below this line are helpers to test the code ----------------
 
 def extract_item_id(request):
-    parsed = urllib.urlparse(request)
-    query = urllib.parse_qs(parsed.query)
+    parsed = urlparse(request)
+    query = parse_qs(parsed.query)
     return (query.get('item') or [None])[0]
 
 def is_dynamic(request):
-    parsed = urllib.urlparse(request)
-    query = urllib.parse_qs(parsed.query)
+    parsed = urlparse(request)
+    query = parse_qs(parsed.query)
     return '_' in query
 
 def hash_request(request):
@@ -194,6 +516,9 @@ class TestCh02(unittest.TestCase):
         conn = self.conn
         to_del = (
             conn.keys('login:*') + conn.keys('recent:*') + conn.keys('viewed:*') +
+            conn.keys('viewed-epoch:*') + conn.keys('viewed-next:*') +
+            conn.keys('viewed-rescale:*') + conn.keys('viewed-sketch:*') +
+            conn.keys('viewed-topk:*') + conn.keys('views:*') +
             conn.keys('cart:*') + conn.keys('cache:*') + conn.keys('delay:*') + 
             conn.keys('schedule:*') + conn.keys('inv:*'))
         if to_del:
@@ -254,6 +579,14 @@ class TestCh02(unittest.TestCase):
 
         self.assertTrue(len(r) >= 1)
 
+        print("Let's update several items at once, and read the cart back")
+        update_cart(conn, token, {'itemY': 0, 'itemZ': 2, 'itemW': 1})
+        cart = get_cart(conn, token)
+        print("Our shopping cart snapshot is:", cart)
+        print
+        self.assertEqual(len(cart), 2)
+        self.assertTrue(conn.ttl('cart:' + token) > 0)
+
         print("Let's clean out our sessions and carts")
         LIMIT = 0
         t = threading.Thread(target=clean_full_sessions, args=(conn,))
@@ -292,6 +625,14 @@ class TestCh02(unittest.TestCase):
 
         self.assertEquals(result, result2)
 
+        print("An unpopular item isn't cached, so the callback is called every time")
+        url = 'http://test.com/?item=itemZ'
+        self.assertEqual(cache_request(conn, url, callback), "content for " + url)
+        self.assertFalse(conn.exists('cache:' + hash_request(url)))
+
+        print("The most viewed items this hour are:", get_top_items(conn, 'hour'))
+        self.assertTrue(get_top_items(conn, 'hour'))
+
         self.assertFalse(can_cache(conn, 'http://test.com/'))
         self.assertFalse(can_cache(conn, 'http://test.com/?item=itemX&_=1234536'))
 
@@ -340,6 +681,47 @@ class TestCh02(unittest.TestCase):
         if t.isAlive():
             raise Exception("The database caching thread is still alive?!?")
 
+    def test_rescale_viewed(self):
+        conn = self.conn
+        global QUIT
+
+        print("Let's pretend the decay epoch started long ago, and view some items")
+        conn.set('viewed-epoch:', time.time() - 2 * VIEWED_RENORMALIZE)
+        token = str(uuid.uuid4())
+        for i in range(5):
+            for j in range(i + 1):
+                update_token(conn, token, 'username', 'item%s' % i)
+        before = conn.zrange('viewed:', 0, -1)
+        print("The items ranked by views:", before)
+        self.assertEqual(len(before), 5)
+
+        print("We'll start a rescaling thread that will renormalize the scores...")
+        t = threading.Thread(target=rescale_viewed, args=(conn,))
+        t.setDaemon(1)
+        t.start()
+        time.sleep(1)
+        QUIT = True
+        time.sleep(2)
+        if t.isAlive():
+            raise Exception("The rescale viewed thread is still alive?!?")
+
+        after = conn.zrange('viewed:', 0, -1)
+        print("The items ranked by views after renormalizing:", after)
+        self.assertEqual(before, after)
+        self.assertTrue(float(conn.get('viewed-epoch:')) > time.time() - 10)
+        self.assertFalse(conn.exists('viewed-rescale:'))
+
+        print("Even if the rescaling daemon has been down for hours, views are still counted")
+        conn.set('viewed-epoch:', time.time() - 10 * 3600)
+        update_token(conn, token, 'username', 'item0')
+        self.assertAlmostEqual(conn.zscore('viewed:', 'item0') / -math.exp(VIEWED_MAX_EXPONENT), 1)
+
+    def test_view_sketch(self):
+        print("Let's compare exact view counting against the Count-Min sketch")
+        overlap, error = benchmark_view_tracking(self.conn, 20000, 1000, 20)
+        self.assertTrue(overlap >= .8)
+        self.assertTrue(0 <= error < .1)
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -1,43 +1,105 @@
 #! encoding=utf-8
+import binascii
+import copy
+import heapq
+import itertools
 import os
+import pprint
+import random
+import subprocess
+import sys
+import threading
 import time
 import unittest
 import uuid
 
 import redis
 
-#--------------- Redis事务：定义用户信息和用户包裹 ----------------#
-def list_item(conn, itemid, sellerid, price):
-    '''卖家sellerid将包裹里面的商品放到市场上销售'''
-    inventory = "inventory:%s" % sellerid # 卖家包裹
-    item = "%s.%s" % (itemid, sellerid) # 有序集合market:中存放的商品格式：商品id.卖家id
-    end = time.time() + 5
-    # 创建事务流水线，来执行事务操作
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ch02'))
+import ch02_listing_source as ch02
+
+#--------------- 乐观锁事务：带退避重试的WATCH/MULTI/EXEC ----------------#
+TXN_STATS = {} # 每个事务函数的提交、冲突、重试和放弃次数
+_TXN_LOCK = threading.Lock()
+
+def _count_txn(name, counter):
+    '''为事务函数name的计数器counter加1'''
+    with _TXN_LOCK:
+        stats = TXN_STATS.setdefault(
+            name, {'commits': 0, 'conflicts': 0, 'retries': 0, 'aborts': 0})
+        stats[counter] += 1
+
+def run_optimistic(conn, name, txn, timeout, base_delay=.001, max_delay=.05):
+    '''
+    执行乐观锁事务txn(pipe)：txn负责WATCH需要监视的键并检查条件，条件不满足时返回None；
+    条件满足时调用pipe.multi()，把命令加入队列后返回True。
+    如果在执行EXEC命令之前监视的键被修改，则按带随机抖动的指数退避等待后重试，
+    超过timeout秒仍未成功则放弃并返回False
+    '''
+    end = time.time() + timeout
     pipe = conn.pipeline()
-    # 如果执行时间小于5秒仍然为成功，则重试
-    while time.time() < end:
+    attempt = 0
+    while True:
         try:
-            # 监视用户包裹是否发生变化，如果执行EXEC命令之前发生了变化，则Redis拒绝执行事务
-            pipe.watch(inventory)
-            # 检查用户包裹是否仍然持有该商品
-            if not pipe.sismember(inventory, itemid):
-                pipe.unwatch()
+            if not txn(pipe):
+                # 条件不满足，取消监视
+                pipe.reset()
                 return None
-            # 准备执行事务，把一系列命令加入到队列中
-            pipe.multi()
-            # 将商品(有序结合的成员)和价格(有序集合的分值)加入到market:有序集合中
-            pipe.zadd('market:', item, price)
-            # 商品被加入到市场market:中，因此需要把商品移出卖家包裹
-            pipe.srem(inventory, itemid)
-            # 开始执行事务
             pipe.execute()
-            # 事务执行成功，返回True
+            _count_txn(name, 'commits')
             return True
         # 如果在执行EXEC命令之前，有其他操作更改了监视的建，则引发WatchError
         except redis.exceptions.WatchError:
-            pass
-        # 5秒还未能执行事务，则返回False
-        return False
+            _count_txn(name, 'conflicts')
+        delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+        if time.time() + delay >= end:
+            _count_txn(name, 'aborts')
+            return False
+        _count_txn(name, 'retries')
+        attempt += 1
+        time.sleep(delay)
+
+#--------------- 市场分区：按商品id的哈希值把市场拆分成多个有序集合 ----------------#
+MARKET_PARTITIONS = 1 # 市场分区的数量，为1时所有商品都放在market:中
+
+def market_key(itemid):
+    '''商品itemid所在的市场分区，同一商品的所有挂单总是在同一个分区中'''
+    if MARKET_PARTITIONS == 1:
+        return 'market:'
+    return 'market:%s:' % ((binascii.crc32(itemid) & 0xffffffff) % MARKET_PARTITIONS)
+
+def market_partitions():
+    '''所有的市场分区'''
+    if MARKET_PARTITIONS == 1:
+        return ['market:']
+    return ['market:%s:' % i for i in xrange(MARKET_PARTITIONS)]
+
+#--------------- Redis事务：定义用户信息和用户包裹 ----------------#
+def list_item(conn, itemid, sellerid, price):
+    '''卖家sellerid将包裹里面的商品放到市场上销售'''
+    inventory = "inventory:%s" % sellerid # 卖家包裹
+    item = "%s.%s" % (itemid, sellerid) # 有序集合market:中存放的商品格式：商品id.卖家id
+    market = market_key(itemid) # 商品所在的市场分区
+
+    def txn(pipe):
+        # 监视用户包裹是否发生变化，如果执行EXEC命令之前发生了变化，则Redis拒绝执行事务
+        pipe.watch(inventory)
+        # 检查用户包裹是否仍然持有该商品
+        if not pipe.sismember(inventory, itemid):
+            return None
+        # 准备执行事务，把一系列命令加入到队列中
+        pipe.multi()
+        # 将商品(有序结合的成员)和价格(有序集合的分值)加入到market:有序集合中
+        pipe.zadd(market, item, price)
+        # 同时加入按商品和按卖家划分的二级索引
+        pipe.zadd('market:item:%s' % itemid, item, price)
+        pipe.zadd('market:seller:%s' % sellerid, item, price)
+        # 商品被加入到市场market:中，因此需要把商品移出卖家包裹
+        pipe.srem(inventory, itemid)
+        return True
+
+    # 5秒还未能执行事务，则返回False
+    return run_optimistic(conn, 'list_item', txn, 5)
 
 #--------------- Redis事务：买家从市场购买商品 ----------------#
 def purchase_item(conn, buyerid, itemid, sellerid, lprice):
@@ -46,36 +108,285 @@ def purchase_item(conn, buyerid, itemid, sellerid, lprice):
     seller = 'users:%s' % sellerid
     inventory = "inventory:%s" % buyerid # 买家包裹
     item = "%s.%s" % (itemid, sellerid) # 有序集合market中存放的商品格式：商品id.卖家id
+    market = market_key(itemid) # 商品所在的市场分区
 
-    end = time.time() + 10
-    pipe = conn.pipeline()
+    def txn(pipe):
+        # 监视市场分区和买家的个人信息进行监视，其他分区的商品变化不会导致重试
+        pipe.watch(market, buyer)
+        # 检查商品是否仍在市场上、买家要购买的商品价格是否发生了变化、买家是否有足够的钱来购买商品
+        # 如果上述条件有一个满足，则取消监视
+        price = pipe.zscore(market, item)
+        funds = int(pipe.hget(buyer, "funds") or 0)
+        if price is None or price != lprice or funds < price:
+            return None
 
-    while time.time() < end:
-        try:
-            # 监视市场和买家的个人信息进行监视
-            pipe.watch('maret:', buyer)
-            # 检查买家要购买的商品价格是否发生了变化或者买家是否有足够的钱来购买商品
-            # 如果上述条件有一个满足，则取消监视
-            price = pipe.zscore('market:', item)
-            funds = int(pipe.hget(buyer, "funds"))
-            if price != lprice or funds < price:
-                pipe.unwatch()
-                return None
-            
-            pipe.multi()
-            # 卖家的钱包增加一个商品的价格，买家的钱包减少一个商品的价格
-            pipe.hincrby(seller, "funds", int(price))
-            pipe.hincrby(buyer, "funds", int(-price))
-            # 买家的包裹增加一个商品
-            pipe.sadd(inventory, itemid)
-            # 市场上该商品被移除
-            pipe.zrem('market:', item)
-            pipe.execute()
-            return True
-        except redis.exceptions.WatchError:
-            pass
-        # 10秒还未能执行事务，则返回False
-        return False
+        pipe.multi()
+        # 卖家的钱包增加一个商品的价格，买家的钱包减少一个商品的价格
+        pipe.hincrby(seller, "funds", int(price))
+        pipe.hincrby(buyer, "funds", int(-price))
+        # 买家的包裹增加一个商品
+        pipe.sadd(inventory, itemid)
+        # 市场上该商品被移除
+        pipe.zrem(market, item)
+        pipe.zrem('market:item:%s' % itemid, item)
+        pipe.zrem('market:seller:%s' % sellerid, item)
+        return True
+
+    # 10秒还未能执行事务，则返回False
+    return run_optimistic(conn, 'purchase_item', txn, 10)
+
+def benchmark_purchase_contention(conn, buyers, rounds):
+    '''每一轮把同一件商品重新上架，由buyers个买家线程同时抢购，统计吞吐量和事务冲突次数'''
+    TXN_STATS.clear()
+    for i in xrange(buyers):
+        conn.hset('users:buyer%s' % i, 'funds', rounds * 10)
+    start = time.time()
+    for r in xrange(rounds):
+        conn.sadd('inventory:seller', 'item')
+        list_item(conn, 'item', 'seller', 10)
+        threads = [
+            threading.Thread(target=purchase_item,
+                             args=(conn, 'buyer%s' % i, 'item', 'seller', 10))
+            for i in xrange(buyers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    delta = time.time() - start
+    print 'purchase_item', buyers, rounds, delta, rounds / delta
+    print TXN_STATS.get('purchase_item')
+    return TXN_STATS.get('purchase_item')
+
+#--------------- Lua脚本：不使用WATCH的市场操作 ----------------#
+# 脚本执行的结果
+LISTED = 'listed'
+NOT_IN_INVENTORY = 'not-in-inventory'
+PURCHASED = 'purchased'
+SOLD_OUT = 'sold-out'
+PRICE_CHANGED = 'price-changed'
+INSUFFICIENT_FUNDS = 'insufficient-funds'
+
+LIST_ITEM_LUA = '''
+if redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 0 then
+    return 'not-in-inventory'
+end
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[2])
+redis.call('ZADD', KEYS[3], ARGV[3], ARGV[2])
+redis.call('ZADD', KEYS[4], ARGV[3], ARGV[2])
+redis.call('SREM', KEYS[1], ARGV[1])
+return 'listed'
+'''
+
+PURCHASE_ITEM_LUA = '''
+local price = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if not price then
+    return 'sold-out'
+end
+price = tonumber(price)
+if price ~= tonumber(ARGV[3]) then
+    return 'price-changed'
+end
+if tonumber(redis.call('HGET', KEYS[2], 'funds') or 0) < price then
+    return 'insufficient-funds'
+end
+local amount = math.floor(price)
+redis.call('HINCRBY', KEYS[3], 'funds', amount)
+redis.call('HINCRBY', KEYS[2], 'funds', -amount)
+redis.call('SADD', KEYS[4], ARGV[2])
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('ZREM', KEYS[5], ARGV[1])
+redis.call('ZREM', KEYS[6], ARGV[1])
+return 'purchased'
+'''
+
+def list_item_lua(conn, itemid, sellerid, price):
+    '''与list_item相同，但在服务器端用脚本原子地执行，返回LISTED或NOT_IN_INVENTORY'''
+    inventory = "inventory:%s" % sellerid
+    item = "%s.%s" % (itemid, sellerid)
+    return conn.register_script(LIST_ITEM_LUA)(
+        keys=[inventory, market_key(itemid), 'market:item:%s' % itemid, 'market:seller:%s' % sellerid],
+        args=[itemid, item, price])
+
+def purchase_item_lua(conn, buyerid, itemid, sellerid, lprice):
+    '''
+    与purchase_item相同，但价格检查、余额检查、转账、移动商品和下架都在脚本中原子地执行，
+    不需要监视market:，其他商品的上架和购买不会导致重试。
+    返回PURCHASED、SOLD_OUT、PRICE_CHANGED或INSUFFICIENT_FUNDS
+    '''
+    buyer = 'users:%s' % buyerid
+    seller = 'users:%s' % sellerid
+    inventory = "inventory:%s" % buyerid
+    item = "%s.%s" % (itemid, sellerid)
+    return conn.register_script(PURCHASE_ITEM_LUA)(
+        keys=[market_key(itemid), buyer, seller, inventory,
+              'market:item:%s' % itemid, 'market:seller:%s' % sellerid],
+        args=[item, itemid, lprice])
+
+#--------------- 按价格浏览市场 ----------------#
+# 从游标（上一页最后一件商品的价格和成员）之后开始，按价格从低到高返回最多count件
+# 价格不超过上限的商品。游标对应的商品仍在市场上时，直接从它的排名之后开始；
+# 已被买走时，从同价格的第一件商品开始并跳过游标之前的同价商品。有序集合的成员按字节比较排序，
+# 而Lua的字符串比较使用strcoll，会受服务器的区域设置影响，所以这里逐字节比较成员。
+# 除了跳过同价商品以外，每次查询的复杂度为O(log(N) + count)
+BROWSE_MARKET_LUA = '''
+local function after(member, cursor)
+    local length = math.min(#member, #cursor)
+    for i = 1, length do
+        local a, b = string.byte(member, i), string.byte(cursor, i)
+        if a ~= b then
+            return a > b
+        end
+    end
+    return #member > #cursor
+end
+local function bound(value)
+    if value == '-inf' then
+        return -math.huge
+    elseif value == '+inf' or value == 'inf' then
+        return math.huge
+    end
+    return tonumber(value)
+end
+local upper = bound(ARGV[2])
+local count = tonumber(ARGV[3])
+local after_score = bound(ARGV[1])
+local after_member = nil
+local start = nil
+if ARGV[5] ~= '' then
+    after_score = tonumber(ARGV[4])
+    after_member = ARGV[5]
+    local rank = redis.call('ZRANK', KEYS[1], after_member)
+    if rank then
+        -- 排名之后的商品都在游标之后，不需要再比较价格和成员
+        start = rank + 1
+        after_score = -math.huge
+        after_member = nil
+    else
+        start = redis.call('ZCOUNT', KEYS[1], '-inf', '(' .. ARGV[4])
+    end
+else
+    start = redis.call('ZCOUNT', KEYS[1], '-inf', '(' .. ARGV[1])
+end
+local result = {}
+while true do
+    local batch = redis.call('ZRANGE', KEYS[1], start, start + count - 1, 'WITHSCORES')
+    if #batch == 0 then
+        return result
+    end
+    for i = 1, #batch, 2 do
+        local score = tonumber(batch[i + 1])
+        if score > upper then
+            return result
+        end
+        if score > after_score or (score == after_score and
+                (not after_member or after(batch[i], after_member))) then
+            result[#result + 1] = batch[i]
+            result[#result + 1] = batch[i + 1]
+            if #result == 2 * count then
+                return result
+            end
+        end
+    end
+    start = start + count
+end
+'''
+
+def browse_market(conn, min_price='-inf', max_price='+inf', cursor=None,
+                  count=25, itemid=None, sellerid=None):
+    '''
+    按价格从低到高浏览市场上价格在min_price和max_price之间的商品，
+    给定itemid或sellerid时只浏览该商品或该卖家的商品（同时给定时按itemid）。
+    市场被分区时，在一次往返中从每个分区各取一页，再按价格归并成一页。
+    返回 ([(商品id.卖家id, 价格), ...], 下一页的游标)，没有下一页时游标为None
+    '''
+    if itemid is not None:
+        keys = ['market:item:%s' % itemid]
+    elif sellerid is not None:
+        keys = ['market:seller:%s' % sellerid]
+    else:
+        keys = market_partitions()
+    after_item, after_price = cursor or ('', '')
+    browse = conn.register_script(BROWSE_MARKET_LUA)
+    pipe = conn.pipeline(False)
+    for key in keys:
+        browse(keys=[key], client=pipe,
+               args=[min_price, max_price, count, repr(after_price) if cursor else '', after_item])
+    pages = []
+    for result in pipe.execute():
+        pages.append([(float(result[i + 1]), result[i]) for i in xrange(0, len(result), 2)])
+    # 每个分区的结果都已按价格排好序，归并后取前count件
+    page = [(member, price) for price, member in itertools.islice(heapq.merge(*pages), count)]
+    next_cursor = page[-1] if len(page) == count else None
+    return page, next_cursor
+
+def benchmark_market_activity(conn, duration, noise):
+    '''
+    在noise个线程不断上架、下架其他商品的同时，测试一段时间duration之内
+    purchase_item和purchase_item_lua反复购买同一件商品的吞吐量
+    '''
+    def churn(i, stop):
+        member = 'noise%s.seller' % i
+        while not stop.is_set():
+            conn.zadd(market_key(member), member, 1)
+            conn.zrem(market_key(member), member)
+
+    rates = {}
+    for function in (purchase_item, purchase_item_lua):
+        conn.hset('users:buyer', 'funds', 1 << 40)
+        stop = threading.Event()
+        threads = [threading.Thread(target=churn, args=(i, stop)) for i in xrange(noise)]
+        for t in threads:
+            t.setDaemon(1)
+            t.start()
+        count = 0
+        start = time.time()
+        end = start + duration
+        while time.time() < end:
+            conn.zadd(market_key('item'), 'item.seller', 10)
+            function(conn, 'buyer', 'item', 'seller', 10)
+            count += 1
+        delta = time.time() - start
+        stop.set()
+        for t in threads:
+            t.join()
+        rates[function.__name__] = count / delta
+        print function.__name__, noise, count, delta, count / delta
+    return rates
+
+def benchmark_market_partitions(conn, duration, threads, partitions=(1, 2, 4, 8)):
+    '''
+    对不同的分区数量，测试threads个卖家线程在一段时间duration之内不断上架新商品、
+    并由对应的买家买走时，purchase_item的吞吐量
+    '''
+    global MARKET_PARTITIONS
+    def trade(i, end, counts):
+        seller, buyer = 'seller%s' % i, 'buyer%s' % i
+        conn.hset('users:' + buyer, 'funds', 1 << 40)
+        while time.time() < end:
+            itemid = 'item%s' % random.randrange(1 << 20)
+            conn.sadd('inventory:' + seller, itemid)
+            list_item(conn, itemid, seller, 10)
+            if purchase_item(conn, buyer, itemid, seller, 10):
+                counts[i] += 1
+
+    original = MARKET_PARTITIONS
+    rates = {}
+    try:
+        for count in partitions:
+            MARKET_PARTITIONS = count
+            counts = [0] * threads
+            end = time.time() + duration
+            workers = [threading.Thread(target=trade, args=(i, end, counts))
+                       for i in xrange(threads)]
+            for t in workers:
+                t.start()
+            for t in workers:
+                t.join()
+            rates[count] = sum(counts) / float(duration)
+            print 'purchase_item', count, sum(counts), duration, rates[count]
+    finally:
+        MARKET_PARTITIONS = original
+    return rates
 
 
 #---------------非事务非流水线 ----------------#
@@ -87,7 +398,11 @@ def update_token(conn, token, user, item=None):
     if item:
         conn.zadd('viewed:' + token, item, timestamp)   
         conn.zremrangebyrank('viewed:' + token, 0, -26) 
-        conn.zincrby('viewed:', item, -1)
+        # 与第2章相同，按衰减权重记录商品的浏览次数，使用近似统计时只在本地累加
+        if ch02.VIEW_SKETCH:
+            ch02.record_view(item)
+        else:
+            ch02.view_item(conn, item, timestamp)
 
 #---------------非事务流水线：进一步提高性能 ----------------#
 def update_token_pipeline(conn, token, user, item=None):
@@ -99,7 +414,10 @@ def update_token_pipeline(conn, token, user, item=None):
     if item:
         pipe.zadd('viewed:' + token, item, timestamp)   
         pipe.zremrangebyrank('viewed:' + token, 0, -26) 
-        pipe.zincrby('viewed:', item, -1)
+        if ch02.VIEW_SKETCH:
+            ch02.record_view(item)
+        else:
+            ch02.view_item(conn, item, timestamp, client=pipe)
     pipe.execute() 
 
 
@@ -115,6 +433,283 @@ def benchmark_update_token(conn, duration):
         delta = time.time() - start                             
         print function.__name__, count, delta, count / delta    
 
+#--------------- 统计每个函数执行的命令数量、往返次数、字节数和耗时 ----------------#
+INSTRUMENT = False # 为False时instrument()直接返回原来的连接，不会带来任何额外开销
+# 这些辅助函数执行的命令统计到调用它们的函数上，例如第2章update_token中的view_item和update_windows
+INSTRUMENT_HELPERS = set(['run_optimistic', 'view_item', 'update_windows', 'get_window_top'])
+COMMAND_STATS = {'functions': {}, 'families': {}}
+_STATS_LOCK = threading.Lock()
+
+def instrument(conn):
+    '''
+    返回一个与conn共享连接池的连接，通过它执行的命令和流水线都会按调用函数和键族统计到
+    COMMAND_STATS中；INSTRUMENT为False时直接返回conn
+    '''
+    if not INSTRUMENT:
+        return conn
+    wrapped = copy.copy(conn)
+    original_pipeline = conn.pipeline
+
+    def execute_command(*args, **options):
+        start = time.time()
+        result = conn.execute_command(*args, **options)
+        _record_commands([args], time.time() - start, result, pipelined=False)
+        return result
+
+    def pipeline(*args, **kwargs):
+        return _instrument_pipeline(original_pipeline(*args, **kwargs))
+
+    # 实例属性会覆盖类中的同名方法，各个命令方法都会通过self.execute_command执行
+    wrapped.execute_command = execute_command
+    wrapped.pipeline = pipeline
+    return wrapped
+
+def _instrument_pipeline(pipe):
+    '''统计流水线：WATCH之后立即执行的命令各算一次往返，排队的命令在execute时算一次往返'''
+    original_command = pipe.execute_command
+    original_execute = pipe.execute
+
+    def execute_command(*args, **options):
+        if (pipe.watching or args[0] == 'WATCH') and not pipe.explicit_transaction:
+            start = time.time()
+            result = original_command(*args, **options)
+            _record_commands([args], time.time() - start, result, pipelined=False)
+            return result
+        return original_command(*args, **options)
+
+    def execute(*args, **kwargs):
+        commands = [command[0] for command in pipe.command_stack]
+        start = time.time()
+        try:
+            result = original_execute(*args, **kwargs)
+        except redis.exceptions.WatchError:
+            # 被中止的EXEC同样是一次往返，竞争激烈时正是需要统计它们的时候
+            if commands:
+                _record_commands(commands, time.time() - start, None, pipelined=True)
+            raise
+        if commands:
+            _record_commands(commands, time.time() - start, result, pipelined=True)
+        return result
+
+    pipe.execute_command = execute_command
+    pipe.execute = execute
+    return pipe
+
+def key_family(args):
+    '''命令访问的第一个键所属的键族，例如article:92617 -> article:，viewed:<token> -> viewed:'''
+    if args[0] in ('EVAL', 'EVALSHA'):
+        key = args[3] if len(args) > 3 and int(args[2]) else ''
+    else:
+        key = args[1] if len(args) > 1 else ''
+    key = str(key)
+    return key[:key.index(':') + 1] if ':' in key else key
+
+def _caller():
+    '''调用栈中最近的一个模块级函数（跳过redis客户端、闭包和INSTRUMENT_HELPERS）的名字'''
+    frame = sys._getframe(2)
+    while frame is not None:
+        name = frame.f_code.co_name
+        function = frame.f_globals.get(name)
+        if (getattr(function, '__code__', None) is frame.f_code
+                and name not in INSTRUMENT_HELPERS):
+            return name
+        frame = frame.f_back
+    return '<unknown>'
+
+def _size(value):
+    '''命令参数或返回值的大致字节数'''
+    if isinstance(value, (list, tuple)):
+        return sum(_size(v) for v in value)
+    if isinstance(value, dict):
+        return sum(_size(k) + _size(v) for k, v in value.iteritems())
+    if value is None:
+        return 0
+    return len(str(value))
+
+def _record_commands(commands, seconds, result, pipelined):
+    '''记录一次往返执行的命令，耗时按命令数量平均分摊到各个键族上'''
+    caller = _caller()
+    share = seconds / len(commands)
+    with _STATS_LOCK:
+        stats = COMMAND_STATS['functions'].setdefault(caller, {
+            'commands': 0, 'pipelines': 0, 'round_trips': 0, 'bytes': 0, 'time': 0})
+        stats['commands'] += len(commands)
+        stats['pipelines'] += int(pipelined)
+        stats['round_trips'] += 1
+        stats['bytes'] += _size(commands) + _size(result)
+        stats['time'] += seconds
+        for args in commands:
+            family = COMMAND_STATS['families'].setdefault(key_family(args), {
+                'commands': 0, 'bytes': 0, 'time': 0})
+            family['commands'] += 1
+            family['bytes'] += _size(args)
+            family['time'] += share
+
+def get_command_stats():
+    '''导出当前的统计数据'''
+    with _STATS_LOCK:
+        return copy.deepcopy(COMMAND_STATS)
+
+def reset_command_stats():
+    '''清空统计数据'''
+    with _STATS_LOCK:
+        COMMAND_STATS['functions'].clear()
+        COMMAND_STATS['families'].clear()
+
+#--------------- 自动流水线：把多个线程并发执行的命令合并到同一个流水线中 ----------------#
+def autopipeline(conn, delay=.00005, max_batch=1000):
+    '''
+    返回一个与conn共享连接池的连接，调用方式与普通连接相同。多个线程通过它并发执行的命令
+    会被合并到同一个非事务流水线中发送：第一个发出命令的线程成为领导者，等待delay秒收集
+    其他线程的命令后，一次发送最多max_batch个命令，并把结果分发给各个线程；
+    如果还有排队的命令，就由排在最前面的线程接着发送下一批。
+    pipeline()返回的流水线和事务不受影响；阻塞命令会让同一批的其他命令一起等待，不应通过它执行
+    '''
+    wrapped = copy.copy(conn)
+    lock = threading.Lock()
+    pending = []
+    state = {'flushing': False}
+    stats = wrapped.autopipeline_stats = {'commands': 0, 'batches': 0}
+
+    def flush(batch):
+        pipe = conn.pipeline(False)
+        for args, options, slot in batch:
+            pipe.execute_command(*args, **options)
+        try:
+            results = pipe.execute(raise_on_error=False)
+        except Exception as error:
+            results = [error] * len(batch)
+        for (args, options, slot), result in zip(batch, results):
+            slot['result'] = result
+            slot['done'].set()
+        stats['commands'] += len(batch)
+        stats['batches'] += 1
+
+    def execute_command(*args, **options):
+        slot = {'done': threading.Event()}
+        with lock:
+            pending.append((args, options, slot))
+            lead = not state['flushing']
+            state['flushing'] = True
+        if not lead:
+            slot['done'].wait()
+            lead = slot.pop('lead', False)
+        if lead:
+            # 自己的命令总是排在队列的最前面，所以一定会在这一批中发送
+            if delay:
+                time.sleep(delay)
+            with lock:
+                batch = pending[:max_batch]
+                del pending[:max_batch]
+            flush(batch)
+            with lock:
+                if pending:
+                    following = pending[0][2]
+                    following['lead'] = True
+                    following['done'].set()
+                else:
+                    state['flushing'] = False
+        result = slot['result']
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    wrapped.execute_command = execute_command
+    return wrapped
+
+def benchmark_autopipeline(conn, duration, threads=64):
+    '''与benchmark_update_token相同，但由threads个线程并发调用，比较普通连接和自动流水线连接'''
+    for name, client in (('plain', conn), ('autopipeline', autopipeline(conn))):
+        for function in (update_token, update_token_pipeline):
+            counts = [0] * threads
+            start = time.time()
+            end = start + duration
+
+            def run(i):
+                while time.time() < end:
+                    function(client, 'token%s' % i, 'user', 'item')
+                    counts[i] += 1
+
+            workers = [threading.Thread(target=run, args=(i,)) for i in xrange(threads)]
+            for t in workers:
+                t.start()
+            for t in workers:
+                t.join()
+            delta = time.time() - start
+            print name, function.__name__, sum(counts), delta, sum(counts) / delta
+
+#--------------- 读写分离：把只读调用路由到从服务器 ----------------#
+class ReplicaRouter(object):
+    '''
+    在主服务器primary和从服务器列表replicas之间路由连接：
+    只读调用（get_articles、get_group_articles、check_token、can_cache以及cache:、inv:的读取）
+    使用reader()返回的连接，写入使用writer()返回的主服务器连接，写入完成后调用wrote()记录会话的写入。
+    每隔check_interval秒比较主从服务器的复制偏移量，只使用连接正常、落后不超过max_lag字节的从服务器；
+    一个会话写入之后，在某个从服务器确认已经复制到写入之后的偏移量之前，这个会话的读取都发送到主服务器
+    '''
+    def __init__(self, primary, replicas, max_lag=1 << 20, check_interval=1):
+        self.primary = primary
+        self.replicas = replicas
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.checked = 0
+        self.healthy = []               # 可以读取的从服务器
+        self.offsets = [0] * len(replicas) # 每个从服务器最近一次确认已经复制到的偏移量
+        self.writes = {}                # 会话 -> 最近一次写入完成后主服务器的复制偏移量
+        self.lock = threading.Lock()
+
+    def writer(self):
+        '''返回用于写入的主服务器连接'''
+        return self.primary
+
+    def wrote(self, session):
+        '''
+        在会话session的写入完成之后调用：记录此时主服务器的复制偏移量，
+        复制到这个偏移量的从服务器一定已经包含了这次写入
+        '''
+        offset = self.primary.info('replication')['master_repl_offset']
+        with self.lock:
+            self.writes[session] = max(offset, self.writes.get(session, 0))
+
+    def reader(self, session=None):
+        '''返回用于只读调用的连接：会话session能读到自己写入的数据的健康从服务器，否则返回主服务器'''
+        if time.time() - self.checked >= self.check_interval:
+            self.check()
+        with self.lock:
+            written = self.writes.get(session)
+            candidates = [i for i in self.healthy
+                          if written is None or self.offsets[i] >= written]
+        if not candidates:
+            return self.primary
+        return self.replicas[random.choice(candidates)]
+
+    def check(self):
+        '''比较主从服务器的复制偏移量，更新可以读取的从服务器'''
+        now = time.time()
+        offset = self.primary.info('replication')['master_repl_offset']
+        healthy = []
+        offsets = list(self.offsets)
+        for i, replica in enumerate(self.replicas):
+            try:
+                info = replica.info('replication')
+            except redis.exceptions.ConnectionError:
+                continue
+            if info.get('master_link_status') != 'up':
+                continue
+            offsets[i] = info.get('slave_repl_offset', 0)
+            if offset - offsets[i] <= self.max_lag:
+                healthy.append(i)
+        with self.lock:
+            self.checked = now
+            self.healthy = healthy
+            self.offsets = offsets
+            # 所有从服务器（包括暂时不健康的）都已经复制了的写入不再需要记录，
+            # 否则一个落后的从服务器恢复健康之后，会话可能读不到自己写入的数据
+            oldest = min(offsets or [0])
+            for session, written in list(self.writes.items()):
+                if written <= oldest:
+                    del self.writes[session]
+
 #--------------- Below this line are helpers to test the code ----------------
 
 class TestCh04(unittest.TestCase):
@@ -133,7 +728,95 @@ class TestCh04(unittest.TestCase):
     # we don't want to do.
 
     # We also can't test wait_for_sync, as we can't guarantee that there are
-    # multiple Redis servers running with the proper configuration
+    # multiple Redis servers running with the proper configuration; the replica
+    # router test starts its own pair of redis-server processes instead
+
+    def start_redis(self, port, *args):
+        devnull = open(os.devnull, 'w')
+        self.addCleanup(devnull.close)
+        try:
+            process = subprocess.Popen(
+                ['redis-server', '--port', str(port), '--save', '', '--appendonly', 'no'] + list(args),
+                stdout=devnull)
+        except OSError:
+            self.skipTest("redis-server is not installed")
+        self.addCleanup(process.wait)
+        self.addCleanup(process.terminate)
+        conn = redis.Redis(port=port)
+        for i in xrange(50):
+            try:
+                conn.ping()
+                return conn
+            except redis.exceptions.ConnectionError:
+                time.sleep(.1)
+        self.fail("redis-server on port %s didn't start" % port)
+
+    def wait_for_link(self, replica):
+        for i in xrange(50):
+            if replica.info('replication').get('master_link_status') == 'up':
+                return
+            time.sleep(.1)
+        self.fail("the replica didn't connect to the primary")
+
+    def test_replica_router(self):
+        primary = self.start_redis(16379)
+        replica = self.start_redis(16380, '--slaveof', '127.0.0.1', '16379')
+        self.wait_for_link(replica)
+
+        router = ReplicaRouter(primary, [replica], check_interval=.1)
+        print "Reads without writes go to the replica..."
+        router.check()
+        self.assertTrue(router.reader() is replica)
+
+        print "Right after a write, that session reads from the primary..."
+        router.check()
+        update_token(router.writer(), 'token', 'user', 'item')
+        router.wrote('token')
+        self.assertTrue(router.reader('token') is primary)
+        self.assertTrue(router.reader() is replica)
+
+        print "Once the replica has caught up, the session reads from it again"
+        for i in xrange(50):
+            time.sleep(.1)
+            if router.reader('token') is replica:
+                break
+        self.assertTrue(router.reader('token') is replica)
+        self.assertEquals(router.reader('token').hget('login:', 'token'), 'user')
+
+    def test_replica_router_recovering_replica(self):
+        primary = self.start_redis(16379)
+        replica = self.start_redis(16380, '--slaveof', '127.0.0.1', '16379')
+        # 第二个从服务器还没有连接到主服务器，相当于暂时宕机
+        stale = self.start_redis(16381)
+        self.wait_for_link(replica)
+
+        router = ReplicaRouter(primary, [replica, stale], check_interval=3600)
+        update_token(router.writer(), 'token', 'user', 'item')
+        router.wrote('token')
+        for i in xrange(50):
+            router.check()
+            if router.reader('token') is replica:
+                break
+            time.sleep(.1)
+        self.assertTrue(router.reader('token') is replica)
+
+        print "The write is kept while a replica that may be behind it is down..."
+        self.assertTrue('token' in router.writes)
+        # 模拟落后的从服务器恢复健康，但还没有复制到这次写入
+        router.healthy = [0, 1]
+        for i in xrange(20):
+            self.assertTrue(router.reader('token') is replica)
+
+        print "Once it has caught up, the record is dropped"
+        stale.slaveof('127.0.0.1', 16379)
+        self.wait_for_link(stale)
+        for i in xrange(50):
+            router.check()
+            if 'token' not in router.writes:
+                break
+            time.sleep(.1)
+        self.assertFalse('token' in router.writes)
+        self.assertEquals(stale.hget('login:', 'token'), 'user')
 
     def test_list_item(self):
         import pprint
@@ -184,6 +867,160 @@ class TestCh04(unittest.TestCase):
         self.assertTrue('itemX' in i)
         self.assertEquals(conn.zscore('market:', 'itemX.userX'), None)
 
+    def test_purchase_contention(self):
+        print "Let's have 8 buyers race for the same item, 20 times"
+        stats = benchmark_purchase_contention(self.conn, 8, 20)
+        self.assertEquals(stats['commits'], 20)
+        self.assertFalse(stats['aborts'])
+
+    def test_purchase_item_lua(self):
+        conn = self.conn
+        conn.sadd('inventory:userX', 'itemX')
+        conn.hset('users:userY', 'funds', 5)
+        print "Listing and buying an item with scripts instead of WATCH..."
+        self.assertEquals(list_item_lua(conn, 'itemX', 'userX', 10), LISTED)
+        self.assertEquals(list_item_lua(conn, 'itemX', 'userX', 10), NOT_IN_INVENTORY)
+        self.assertEquals(purchase_item_lua(conn, 'userY', 'itemX', 'userX', 9), PRICE_CHANGED)
+        self.assertEquals(purchase_item_lua(conn, 'userY', 'itemX', 'userX', 10), INSUFFICIENT_FUNDS)
+        conn.hset('users:userY', 'funds', 125)
+        self.assertEquals(purchase_item_lua(conn, 'userY', 'itemX', 'userX', 10), PURCHASED)
+        self.assertEquals(purchase_item_lua(conn, 'userY', 'itemX', 'userX', 10), SOLD_OUT)
+        self.assertEquals(conn.hget('users:userY', 'funds'), '115')
+        self.assertTrue('itemX' in conn.smembers('inventory:userY'))
+
+    def test_browse_market(self):
+        conn = self.conn
+        for i in xrange(5):
+            conn.sadd('inventory:userX', 'item%s' % i)
+            list_item(conn, 'item%s' % i, 'userX', 10 + i % 2)
+        conn.sadd('inventory:userZ', 'item0')
+        list_item_lua(conn, 'item0', 'userZ', 1)
+
+        print "Browsing the market two items at a time..."
+        seen = []
+        page, cursor = browse_market(conn, 5, 20, count=2)
+        while page:
+            print page
+            seen.extend(page)
+            if not cursor:
+                break
+            page, cursor = browse_market(conn, 5, 20, cursor, count=2)
+        self.assertEquals([member for member, price in seen],
+                          ['item0.userX', 'item2.userX', 'item4.userX', 'item1.userX', 'item3.userX'])
+
+        page, cursor = browse_market(conn, itemid='item0')
+        self.assertEquals(page, [('item0.userZ', 1.0), ('item0.userX', 10.0)])
+        page, cursor = browse_market(conn, sellerid='userZ')
+        self.assertEquals(page, [('item0.userZ', 1.0)])
+        self.assertEquals(cursor, None)
+
+        print "Equal-price items after a sold cursor are compared byte by byte..."
+        conn.zadd('market:', 'item1.userY', 30, 'item10.userX', 30)
+        page, cursor = browse_market(conn, 30, 30, count=1)
+        self.assertEquals(page, [('item1.userY', 30.0)])
+        conn.zrem('market:', 'item1.userY')
+        page, cursor = browse_market(conn, 30, 30, cursor, count=1)
+        self.assertEquals(page, [('item10.userX', 30.0)])
+
+    def test_market_partitions(self):
+        global MARKET_PARTITIONS
+        conn = self.conn
+        MARKET_PARTITIONS = 4
+        try:
+            print "Listing items into 4 market partitions..."
+            for i in xrange(8):
+                conn.sadd('inventory:userX', 'item%s' % i)
+                list_item(conn, 'item%s' % i, 'userX', 10 + i)
+            print "The partitions hold:", [conn.zcard(key) for key in market_partitions()]
+            self.assertFalse(conn.exists('market:'))
+            page, cursor = browse_market(conn, count=5)
+            print "The merged view starts with:", page
+            self.assertEquals([price for member, price in page], [10, 11, 12, 13, 14])
+            page, cursor = browse_market(conn, cursor=cursor, count=5)
+            self.assertEquals([price for member, price in page], [15, 16, 17])
+
+            conn.hset('users:userY', 'funds', 125)
+            self.assertTrue(purchase_item(conn, 'userY', 'item3', 'userX', 13))
+            self.assertEquals(conn.zscore(market_key('item3'), 'item3.userX'), None)
+        finally:
+            MARKET_PARTITIONS = 1
+
+    def test_benchmark_market_partitions(self):
+        benchmark_market_partitions(self.conn, 2, 8)
+
+    def test_benchmark_market_activity(self):
+        for noise in (0, 4):
+            benchmark_market_activity(self.conn, 2, noise)
+
+    def test_instrument(self):
+        global INSTRUMENT
+        self.assertTrue(instrument(self.conn) is self.conn)
+        INSTRUMENT = True
+        try:
+            # 预先载入脚本，避免第一次调用时的SCRIPT LOAD被统计进去
+            self.conn.script_load(ch02.VIEW_ITEM_LUA)
+            reset_command_stats()
+            conn = instrument(self.conn)
+            update_token(conn, 'token', 'user', 'item')
+            update_token_pipeline(conn, 'token', 'user', 'item')
+            conn.sadd('inventory:userX', 'itemX')
+            list_item(conn, 'itemX', 'userX', 10)
+            stats = get_command_stats()
+            print "The functions issued:"
+            pprint.pprint(stats)
+            functions = stats['functions']
+            self.assertEquals(functions['update_token']['commands'], 5)
+            self.assertEquals(functions['update_token']['round_trips'], 5)
+            self.assertEquals(functions['update_token_pipeline']['commands'], 5)
+            self.assertEquals(functions['update_token_pipeline']['round_trips'], 1)
+            # WATCH和SISMEMBER各一次往返，MULTI/EXEC流水线一次往返
+            self.assertEquals(functions['list_item']['round_trips'], 3)
+            self.assertEquals(functions['list_item']['pipelines'], 1)
+            self.assertTrue(stats['families']['market:']['commands'])
+            self.assertTrue(stats['families']['viewed:']['commands'])
+
+            print "An EXEC aborted by a conflicting write is still counted..."
+            reset_command_stats()
+            pipe = conn.pipeline()
+            pipe.watch('market:')
+            self.conn.zadd('market:', 'itemY.userX', 1)
+            pipe.multi()
+            pipe.zadd('market:', 'itemZ.userX', 1)
+            self.assertRaises(redis.exceptions.WatchError, pipe.execute)
+            # 测试方法不是模块级函数，所以统计在<unknown>下
+            self.assertEquals(get_command_stats()['functions']['<unknown>']['pipelines'], 1)
+        finally:
+            INSTRUMENT = False
+            reset_command_stats()
+
+    def test_autopipeline(self):
+        conn = autopipeline(self.conn)
+        errors = []
+
+        def run(i):
+            try:
+                for j in xrange(20):
+                    update_token(conn, 'token%s' % i, 'user%s' % i, 'item')
+                    assert conn.hget('login:', 'token%s' % i) == 'user%s' % i
+            except Exception as error:
+                errors.append(error)
+
+        print "Running update_token from 16 threads through one auto-pipelined connection..."
+        threads = [threading.Thread(target=run, args=(i,)) for i in xrange(16)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        stats = conn.autopipeline_stats
+        print "Commands and batches sent:", stats
+        self.assertFalse(errors)
+        self.assertEquals(stats['commands'], 16 * 20 * 6)
+        self.assertTrue(stats['batches'] < stats['commands'])
+        self.assertRaises(redis.exceptions.ResponseError, conn.incr, 'login:')
+
+    def test_benchmark_autopipeline(self):
+        benchmark_autopipeline(self.conn, 2)
+
     def test_benchmark_update_token(self):
         benchmark_update_token(self.conn, 5)
 
@@ -0,0 +1,146 @@
+#!encoding=utf-8
+'''
+按小时、天、周统计的排行榜：第1章的文章投票数和第2章的商品浏览次数共用这里的实现
+
+    from leaderboards import update_windows, get_window_top
+    update_windows(conn, 'votes:', {'article:1': 1})
+    get_window_top(conn, 'votes:', 'day')
+
+写入时只把计数同时加到当前小时的桶和每个时间窗口的排行榜上，滑出窗口的桶由守护进程
+expire_windows分批从排行榜中减去
+'''
+import time
+import unittest
+
+BUCKET_SECONDS = 3600                                # 每个桶统计一个小时内的计数
+WINDOWS = (('hour', 1), ('day', 24), ('week', 168))  # 每个时间窗口包含的桶数量
+BUCKET_TTL = (2 * 168 + 1) * BUCKET_SECONDS          # 桶的过期时间，保证桶在被减去之前不会过期
+WINDOWS_GRACE = 60           # 一个小时结束这么多秒之后才认为它的桶不会再有写入，可以从窗口中减去
+WINDOWS_CHUNK = 1000         # 守护进程每次最多从窗口中减去的成员数量，保证每次调用的耗时有界
+QUIT = False
+
+#--------------- 写入和读取排行榜 ----------------#
+def update_windows(conn, prefix, counts={}, client=None, now=None):
+    '''
+    把counts中每个成员在当前小时的计数增加对应的数量，同时加到每个时间窗口的排行榜上；
+    给定流水线client时只把命令加入流水线，否则在一个非事务流水线中执行
+    '''
+    if not counts:
+        return
+    bucket = prefix + str(int((now or time.time()) // BUCKET_SECONDS))
+    pipe = client or conn.pipeline(False)
+    for member, amount in counts.items():
+        pipe.zincrby(bucket, member, amount)
+        for window, size in WINDOWS:
+            pipe.zincrby(prefix + window + ':', member, amount)
+    pipe.expire(bucket, BUCKET_TTL)
+    if client is None:
+        pipe.execute()
+
+def get_window_top(conn, prefix, window, count=10):
+    '''
+    返回时间窗口window(hour、day或week)内计数最多的count个成员及其计数；
+    守护进程减去滑出窗口的桶之前，结果中还会包含这些桶的计数
+    '''
+    return conn.zrevrange(prefix + window + ':', 0, count - 1, withscores=True)
+
+#--------------- 从排行榜中减去滑出窗口的桶 ----------------#
+# 从窗口<prefix><window>:中减去桶KEYS[3]（编号ARGV[1]）从位置offset开始的最多ARGV[2]个成员，
+# 进度保存在散列<prefix><window>:progress中：expired为已经减完的最后一个桶，offset为下一个桶中
+# 已经减去的成员数量。桶已经不会再有写入，所以按排名分批处理不会遗漏或重复成员
+EXPIRE_BUCKET_LUA = '''
+local expired = tonumber(redis.call('HGET', KEYS[2], 'expired'))
+if expired ~= tonumber(ARGV[1]) - 1 then
+    return 0
+end
+local chunk = tonumber(ARGV[2])
+local offset = tonumber(redis.call('HGET', KEYS[2], 'offset') or 0)
+local counts = redis.call('ZRANGE', KEYS[3], offset, offset + chunk - 1, 'WITHSCORES')
+for i = 1, #counts, 2 do
+    local left = tonumber(redis.call('ZINCRBY', KEYS[1], -counts[i + 1], counts[i]))
+    if left <= 0 then
+        redis.call('ZREM', KEYS[1], counts[i])
+    end
+end
+if #counts < 2 * chunk then
+    redis.call('HSET', KEYS[2], 'expired', ARGV[1])
+    redis.call('HDEL', KEYS[2], 'offset')
+else
+    redis.call('HSET', KEYS[2], 'offset', offset + chunk)
+end
+return #counts / 2 + 1
+'''
+
+def expire_windows_chunk(conn, prefix, now=None, chunk=WINDOWS_CHUNK):
+    '''
+    对前缀为prefix的每个时间窗口，从排行榜中减去下一个滑出窗口的桶中最多chunk个成员，
+    返回处理的成员和桶的数量，没有需要处理的桶时返回0
+    '''
+    now = now or time.time()
+    latest = int(now // BUCKET_SECONDS)
+    closed = int((now - WINDOWS_GRACE) // BUCKET_SECONDS)
+    expire = conn.register_script(EXPIRE_BUCKET_LUA)
+    done = 0
+    for window, size in WINDOWS:
+        key = prefix + window + ':'
+        progress = key + 'progress'
+        expired = conn.hget(progress, 'expired')
+        if expired is None or int(expired) < closed - 2 * size:
+            # 第一次运行，或者守护进程停止了超过一个窗口的时间：直接用窗口内的桶重建排行榜
+            pipe = conn.pipeline(True)
+            pipe.zunionstore(key, [prefix + str(bucket)
+                                   for bucket in range(closed - size + 1, latest + 1)])
+            pipe.hset(progress, 'expired', closed - size)
+            pipe.hdel(progress, 'offset')
+            pipe.execute()
+            done += 1
+        elif int(expired) < closed - size:
+            bucket = int(expired) + 1
+            done += expire(keys=[key, progress, prefix + str(bucket)], args=[bucket, chunk])
+    return done
+
+def expire_windows(conn, prefixes):
+    '''守护进程函数：不断从prefixes（例如votes:和views:）的各个时间窗口中减去滑出窗口的桶'''
+    while not QUIT:
+        done = sum(expire_windows_chunk(conn, prefix) for prefix in prefixes)
+        time.sleep(.01 if done else 1)
+
+#--------------- Below this line are helpers to test the code ----------------
+
+class TestLeaderboards(unittest.TestCase):
+    def setUp(self):
+        import redis
+        self.conn = redis.Redis(db=15)
+        self.conn.flushdb()
+
+    def tearDown(self):
+        self.conn.flushdb()
+        del self.conn
+
+    def expire(self, now):
+        while expire_windows_chunk(self.conn, 'test:', now, chunk=1):
+            pass
+
+    def test_windows(self):
+        conn = self.conn
+        # 取一个小时的中间时刻，避免测试受整点前后WINDOWS_GRACE秒的影响
+        now = (time.time() // BUCKET_SECONDS + .5) * BUCKET_SECONDS
+        update_windows(conn, 'test:', {'a': 3, 'b': 1}, now=now - 2 * BUCKET_SECONDS)
+        update_windows(conn, 'test:', {'b': 1, 'c': 2}, now=now - BUCKET_SECONDS)
+        update_windows(conn, 'test:', {'c': 1}, now=now)
+        print("Until the daemon runs, every window holds all the counts")
+        self.assertEqual(get_window_top(conn, 'test:', 'hour'), [(b'c', 3), (b'a', 3), (b'b', 2)])
+
+        self.expire(now)
+        self.assertEqual(get_window_top(conn, 'test:', 'hour'), [(b'c', 1)])
+        self.assertEqual(get_window_top(conn, 'test:', 'day'), [(b'c', 3), (b'a', 3), (b'b', 2)])
+
+        print("Old buckets are subtracted member by member as they leave the window")
+        update_windows(conn, 'test:', {'d': 1}, now=now + 22 * BUCKET_SECONDS)
+        self.expire(now + 22 * BUCKET_SECONDS)
+        self.assertEqual(get_window_top(conn, 'test:', 'hour'), [(b'd', 1)])
+        self.assertEqual(get_window_top(conn, 'test:', 'day'), [(b'c', 3), (b'd', 1), (b'b', 1)])
+        self.assertEqual(conn.zscore('test:week:', 'a'), 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+#!encoding=utf-8
+'''
+在线批量删除匹配模式的键：用SCAN按批遍历键空间代替会阻塞整个服务器的KEYS，
+用流水线中的UNLINK在后台释放内存代替一次性删除所有键的DEL，并按目标速率限流、报告进度
+
+    python purge.py 'cache:*' 'viewed:*' --batch 500 --rate 10000
+'''
+import argparse
+import sys
+import time
+import unittest
+
+import redis
+
+UNLINK_CHUNK = 100  # 每条UNLINK命令删除的键数量
+
+def unlink(conn, keys):
+    '''在一个非事务流水线中删除keys，服务器不支持UNLINK（4.0之前）时改用DEL，返回被删除的键数量'''
+    for command in ('UNLINK', 'DEL'):
+        pipe = conn.pipeline(False)
+        for i in range(0, len(keys), UNLINK_CHUNK):
+            pipe.execute_command(command, *keys[i:i + UNLINK_CHUNK])
+        try:
+            return sum(pipe.execute())
+        except redis.exceptions.ResponseError as error:
+            if command != 'UNLINK' or 'unknown command' not in str(error).lower():
+                raise
+    return 0
+
+def purge_keys(conn, patterns, batch=500, rate=None, progress=None):
+    '''
+    删除匹配patterns中任意一个模式的所有键：每次SCAN最多检查batch个键，并立即删除找到的键；
+    给定rate时每秒最多删除rate个键；每删除一批后调用progress(pattern, scanned, deleted, elapsed)。
+    返回被删除的键数量
+    '''
+    start = time.time()
+    scanned = deleted = 0
+    for pattern in patterns:
+        cursor = 0
+        while True:
+            cursor, keys = conn.scan(cursor, match=pattern, count=batch)
+            scanned += len(keys)
+            if keys:
+                deleted += unlink(conn, keys)
+            elapsed = time.time() - start
+            if progress:
+                progress(pattern, scanned, deleted, elapsed)
+            # 删除速度超过目标速率时，等待到符合速率的时间点
+            if rate and deleted > rate * elapsed:
+                time.sleep(deleted / float(rate) - elapsed)
+            if not int(cursor):
+                break
+    return deleted
+
+def print_progress(interval=1):
+    '''返回一个每隔interval秒向标准错误输出一次进度的progress回调'''
+    last = [0]
+    def progress(pattern, scanned, deleted, elapsed):
+        if elapsed - last[0] >= interval:
+            last[0] = elapsed
+            sys.stderr.write('%s: scanned %d, deleted %d keys in %.1fs\n' % (
+                pattern, scanned, deleted, elapsed))
+    return progress
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Delete keys matching patterns without blocking Redis.')
+    parser.add_argument('patterns', nargs='+', help="key patterns, for example 'cache:*'")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6379)
+    parser.add_argument('--db', type=int, default=0)
+    parser.add_argument('--batch', type=int, default=500, help='COUNT hint for each SCAN')
+    parser.add_argument('--rate', type=float, help='maximum keys deleted per second')
+    args = parser.parse_args(argv)
+
+    conn = redis.Redis(host=args.host, port=args.port, db=args.db)
+    start = time.time()
+    deleted = purge_keys(conn, args.patterns, args.batch, args.rate, print_progress())
+    print('deleted %d keys in %.1fs' % (deleted, time.time() - start))
+    return 0
+
+#--------------- Below this line are helpers to test the code ----------------
+
+class TestPurge(unittest.TestCase):
+    def setUp(self):
+        self.conn = redis.Redis(db=15)
+        self.conn.flushdb()
+
+    def tearDown(self):
+        self.conn.flushdb()
+        del self.conn
+
+    def test_purge_keys(self):
+        conn = self.conn
+        pipe = conn.pipeline(False)
+        for i in range(1000):
+            pipe.set('cache:%s' % i, 'page')
+            pipe.sadd('viewed:%s' % i, 'item')
+        pipe.set('login:', 'keep me')
+        pipe.execute()
+
+        reports = []
+        progress = lambda *args: reports.append(args)
+        start = time.time()
+        deleted = purge_keys(conn, ['cache:*', 'viewed:*'], 100, 4000, progress)
+        print('deleted %d keys in %.2fs with %d progress reports' % (
+            deleted, time.time() - start, len(reports)))
+        self.assertEqual(deleted, 2000)
+        self.assertTrue(time.time() - start >= .4)
+        self.assertTrue(len(reports) > 2)
+        self.assertEqual(conn.dbsize(), 1)
+
+if __name__ == '__main__':
+    sys.exit(main())